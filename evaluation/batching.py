@@ -0,0 +1,45 @@
+from torch.utils.data import Sampler
+
+# length-bucketed batching for run_inference: prompts are sorted by tokenized length and
+# packed into batches whose padded size (rows x longest prompt) stays under a token budget,
+# so short reports are no longer padded to the length of long ones
+
+class TokenBudgetBatchSampler(Sampler):
+
+    def __init__(self, lengths, max_tokens, max_batch_size=0):
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        # longest first, so a batch that does not fit in memory fails at the start of the run
+        order = sorted(range(len(self.lengths)), key=lambda i: -self.lengths[i])
+        batches = []
+        batch = []
+        for i in order:
+            longest = self.lengths[batch[0]] if batch else self.lengths[i]
+            full = self.max_batch_size and len(batch) >= self.max_batch_size
+            if batch and (full or (len(batch) + 1) * longest > self.max_tokens):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+def fixed_batches(n, batch_size):
+    # the previous behaviour: batch_size examples at a time in dataset order
+    return [list(range(i, min(i + batch_size, n))) for i in range(0, n, batch_size)]
+
+def padding_efficiency(batches, lengths):
+    # real tokens over padded tokens
+    real = sum(lengths[i] for batch in batches for i in batch)
+    padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    return real / padded if padded else 1.0
@@ -0,0 +1,58 @@
+import time
+import argparse
+import transformers
+
+import generation_path
+from data_io import load_dataset
+from parallel import available_cores, run_parallel_inference
+
+# throughput of data-parallel CPU inference on a RadRevise sample, for each layout of N
+# workers x K/N threads over the same K cores, from one process with every thread to
+# one process per core
+
+def layouts(n_cores, workers=None):
+    # worker counts that split the cores evenly
+    workers = workers or [n for n in range(1, n_cores + 1) if n_cores % n == 0 and (n & (n - 1)) == 0]
+    return [(n, n_cores // n) for n in workers if n_cores // n >= 1]
+
+def main(args):
+    data = load_dataset(args.data_path)
+    data = [data[k] for k in range(min(args.n, len(data)))]
+    n_cores = args.cores or len(available_cores())
+    tokenizer = transformers.AutoTokenizer.from_pretrained(args.model_id, trust_remote_code=True)
+
+    rows = []
+    for n_workers, threads in layouts(n_cores, args.workers):
+        timings = []
+        start = time.perf_counter()
+        results = run_parallel_inference(args.model_id, data, args.batch_size, n_workers, threads, timings=timings,
+                                         token_budget=args.token_budget, report_stopping=args.report_stopping)
+        wall_time = time.perf_counter() - start
+
+        # the slowest worker bounds the throughput, model loading is reported apart
+        inference_time = max(inference for _, inference in timings)
+        load_time = max(load for load, _ in timings)
+        n_tokens = sum(len(ids) for ids in tokenizer([result['predicted'] for result in results])['input_ids'])
+        rows.append((n_workers, threads, load_time, inference_time, wall_time, n_tokens))
+
+    print(f"{len(data)} examples, {n_cores} cores, batch size {args.batch_size}")
+    print(f"{'layout':>10} {'load':>8} {'inference':>10} {'wall':>8} {'examples/s':>11} {'tokens/s':>9}")
+    for n_workers, threads, load_time, inference_time, wall_time, n_tokens in rows:
+        print(f"{f'{n_workers}x{threads}':>10} {load_time:>7.0f}s {inference_time:>9.0f}s {wall_time:>7.0f}s "
+              f"{len(data)/inference_time:>11.2f} {n_tokens/inference_time:>9.1f}")
+    best = max(rows, key=lambda row: row[-1] / row[3])
+    print(f"best layout: {best[0]} workers x {best[1]} threads")
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_id', type=str, help="Model ID on HF")
+    parser.add_argument('--data_path', type=str, default='../data/RadRevise_v0.csv')
+    parser.add_argument('--n', type=int, default=32, help="number of examples")
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--cores', type=int, default=0, help="K, the cores shared by the workers, 0 uses all available")
+    parser.add_argument('--workers', type=int, nargs='+', default=None, help="worker counts to compare (default: powers of two dividing K)")
+    parser.add_argument('--token_budget', type=int, default=0)
+    parser.add_argument('--report_stopping', action='store_true')
+    args = parser.parse_args()
+    main(args)
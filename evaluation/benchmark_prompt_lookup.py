@@ -0,0 +1,88 @@
+import time
+import argparse
+import torch
+import transformers
+from transformers.generation.candidate_generator import PromptLookupCandidateGenerator
+
+import generation_path
+from data_io import load_dataset
+from inference import build_prompt
+
+# greedy decoding with and without prompt-lookup drafts on a RadRevise sample: tokens/sec,
+# draft acceptance rate, and whether the outputs are identical
+
+class DraftCounter:
+    # counts the draft tokens proposed by prompt lookup. each assisted step accepts some of
+    # them plus one token from the model, so accepted = new tokens - steps
+
+    def __init__(self):
+        self.steps = 0
+        self.drafted = 0
+        self.original = PromptLookupCandidateGenerator.get_candidates
+
+    def __enter__(self):
+        counter = self
+        def get_candidates(self, input_ids, *args, **kwargs):
+            candidates = counter.original(self, input_ids, *args, **kwargs)
+            counter.steps += 1
+            counter.drafted += candidates[0].shape[1] - input_ids.shape[1]
+            return candidates
+        PromptLookupCandidateGenerator.get_candidates = get_candidates
+        return self
+
+    def __exit__(self, *exc):
+        PromptLookupCandidateGenerator.get_candidates = self.original
+
+def decode(model, tokenizer, prompts, max_new_tokens, eos_token_id, **generate_kwargs):
+    outputs = []
+    n_tokens = 0
+    start = time.perf_counter()
+    for prompt in prompts:
+        input_ids = tokenizer(prompt, return_tensors='pt').input_ids.to(model.device)
+        with torch.no_grad():
+            output = model.generate(input_ids, do_sample=False, max_new_tokens=max_new_tokens, eos_token_id=eos_token_id,
+                                    pad_token_id=tokenizer.pad_token_id, **generate_kwargs)[0, input_ids.shape[1]:]
+        outputs.append(output.tolist())
+        n_tokens += len(output)
+    return outputs, n_tokens, time.perf_counter() - start
+
+def main(args):
+    data = load_dataset(args.data_path)
+    prompts = [build_prompt(data[k]['instructions'], data[k]['report_text']) for k in range(min(args.n, len(data)))]
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(args.model_id, trust_remote_code=True)
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+    model = transformers.AutoModelForCausalLM.from_pretrained(args.model_id, torch_dtype='auto', device_map='auto',
+                                                              trust_remote_code=True)
+    eos_token_id = [tokenizer.eos_token_id]
+    if tokenizer.convert_tokens_to_ids("<|eot_id|>") not in (None, tokenizer.unk_token_id):
+        eos_token_id.append(tokenizer.convert_tokens_to_ids("<|eot_id|>"))
+
+    plain, plain_tokens, plain_time = decode(model, tokenizer, prompts, args.max_new_tokens, eos_token_id)
+    with DraftCounter() as counter:
+        lookup, lookup_tokens, lookup_time = decode(model, tokenizer, prompts, args.max_new_tokens, eos_token_id,
+                                                    prompt_lookup_num_tokens=args.num_draft,
+                                                    max_matching_ngram_size=args.max_ngram)
+
+    accepted = lookup_tokens - counter.steps
+    mismatches = sum(1 for a, b in zip(plain, lookup) if a != b)
+    print(f"{len(prompts)} examples, greedy, max_new_tokens={args.max_new_tokens}")
+    print(f"plain decoding:   {plain_tokens} tokens in {plain_time:.1f}s, {plain_tokens/plain_time:.1f} tokens/s")
+    print(f"prompt lookup:    {lookup_tokens} tokens in {lookup_time:.1f}s, {lookup_tokens/lookup_time:.1f} tokens/s "
+          f"({plain_time/lookup_time:.2f}x)")
+    print(f"drafts: {counter.drafted} tokens proposed in {counter.steps} steps, {accepted} accepted "
+          f"({accepted/max(counter.drafted, 1):.1%} acceptance, {lookup_tokens/max(counter.steps, 1):.2f} tokens per forward pass)")
+    print(f"{mismatches} of {len(prompts)} outputs differ from plain greedy decoding")
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_id', type=str, help="Model ID on HF")
+    parser.add_argument('--data_path', type=str, default='../data/RadRevise_v0.csv')
+    parser.add_argument('--n', type=int, default=16, help="number of examples")
+    parser.add_argument('--num_draft', type=int, default=10, help="max tokens per draft")
+    parser.add_argument('--max_ngram', type=int, default=3, help="longest n-gram matched against the prompt")
+    parser.add_argument('--max_new_tokens', type=int, default=256)
+    args = parser.parse_args()
+    main(args)
@@ -1,11 +1,25 @@
 import argparse
 import pandas as pd
 from CXRMetric.run_eval import calc_metric
+import generation_path
 from inference import *
+from data_io import load_dataset
+from parallel import run_parallel_inference
 
 def main(args):
-    data = pd.read_csv(args.data_path)
-    gt_reports, predicted_reports = postprocess(run_inference(args.model_id, data, args.batch_size))
+    # RadRevise CSV, or a memory-mapped .arrow/.parquet dataset (see generation/columnar.py)
+    data = load_dataset(args.data_path)
+    kwargs = dict(token_budget=args.token_budget, prefix_cache=args.prefix_cache, prompt_lookup=args.prompt_lookup,
+                  edit_mode=args.edit_mode, report_stopping=args.report_stopping, token_cache=args.token_cache,
+                  predictions=args.predictions, resume=args.resume)
+    if args.workers > 1:
+        # CPU only: the dataset is sharded across processes with their own cores
+        results = run_parallel_inference(args.model_id, data, args.inference_batch_size, args.workers,
+                                         args.threads_per_worker, **kwargs)
+    else:
+        results = run_inference(args.model_id, data, args.inference_batch_size, **kwargs)
+    # the predictions file holds every example, including those predicted before a resume
+    gt_reports, predicted_reports = postprocess(args.model_id, args.predictions or results)
     calc_metric(gt_reports, predicted_reports, args.out_file, False)
 
 if __name__ == "__main__":
@@ -14,5 +28,17 @@ if __name__ == "__main__":
     parser.add_argument('data_path', type=str, default='../data/RadRevise_v0.csv', help="RadRevise dataset")
     parser.add_argument('inference_batch_size', default=32, type=int)
     parser.add_argument('out_file', type=str, default='output/result.csv', help="RadRevise dataset")
+    parser.add_argument('--token_budget', type=int, default=0, help="batch prompts of similar length up to this many padded tokens, 0 keeps fixed-size batches")
+    parser.add_argument('--prefix_cache', action='store_true', help="encode the shared few-shot prompt once and reuse its key/value cache")
+    parser.add_argument('--prompt_lookup', type=int, default=0, help="draft up to this many tokens from the prompt per step, 0 disables it")
+    parser.add_argument('--edit_mode', action='store_true', help="generate line edits and apply them to the original report")
+    parser.add_argument('--report_stopping', action='store_true', help="stop each output once its modified report is complete")
+    parser.add_argument('--token_cache', type=str, default='', help="directory of the pre-tokenized prompt cache, empty disables it")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes for CPU inference, each with its own copy of the model")
+    parser.add_argument('--threads_per_worker', type=int, default=0, help="torch threads (and pinned cores) per worker, 0 splits the available cores evenly")
+    parser.add_argument('--predictions', type=str, default='', help="JSONL file each batch of predictions is appended to")
+    parser.add_argument('--resume', action='store_true', help="skip examples whose id is already in the predictions file")
     args = parser.parse_args()
+    if args.resume and not args.predictions:
+        parser.error("--resume needs --predictions")
     main(args)
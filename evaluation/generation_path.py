@@ -0,0 +1,9 @@
+import os
+import sys
+
+# the dataset loader, report parser and edit ops in ../generation are shared with evaluation.
+# importing this module puts that directory on sys.path, whatever the working directory
+GENERATION_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'generation'))
+
+if GENERATION_DIR not in map(os.path.normpath, sys.path):
+    sys.path.append(GENERATION_DIR)
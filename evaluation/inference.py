@@ -2,9 +2,11 @@ import os
 import pandas as pd
 import json
 from tqdm import tqdm
+import torch
 import transformers
-from torch.utils.data import DataLoader
-from utils import GeneratedDataset, collate_fn
+from batching import TokenBudgetBatchSampler, fixed_batches, padding_efficiency
+from prefix_cache import PrefixCache
+from token_cache import load_or_tokenize, left_pad
 
 def create_chat_template(messages):
     chat = ""
@@ -19,13 +21,125 @@ def create_chat_template(messages):
             chat += f"assistant: {content}\n"
     return chat
 
-def run_inference(model_id, data, batch_size, access_token='', save=False):
+MAIN_PROMPT = """ 
+        You are a radiologist and you're given a radiology report and some instructions to modify the report,  
+        provide the modified report based on the instructions, without other explanations or comments. Examples of input and output: 
+
+        Input:
+        Original report:\n
+        FINDINGS:\n1. Nasogastric tube has been advanced with the first side port in the proximal stomach. \nIMPRESSION:\n2. Nasogastric tube has been advanced. \n3. Overall no substantial change of the lungs." \n
+        Instructions: Instruction 1: Add \"No pulmonary nodules or masses are identified\" to the FINDINGS section. Instruction 2: Remove the last line.\n 
 
-    dataset = GeneratedDataset(data)
-    dataloader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn, num_workers=10, shuffle=False)  
+        Output:
+        Modified Report:\n 
+        FINDINGS:\n1. Nasogastric tube has been advanced with the first side port in the proximal stomach. \n 2. No pulmonary nodules or masses are identified \nIMPRESSION:\n2. Nasogastric tube has been advanced."
+
+        Input: Original report:\n 
+        FINDINGS:\n 1. The lung volumes are low. \n 2. Mild fullness in the right hila. \n 3. No pneumothorax or pleural effusion. \n
+        IMPRESSION:\n 4. Mild fullness in the right hila. \n
+
+        Instructions: Instruction 1: Change Line 2 and Line 4 from "right hila" to "left hila."\n
+
+        Output: Modified Report:\n 
+        FINDINGS:\n 1. The lung volumes are low. \n 2. Mild fullness in the left hila. \n 3. No pneumothorax or pleural effusion. \n
+        IMPRESSION:\n 4. Mild fullness in the left hila. 
+        """
+
+# edit-script mode (see generation/edit_ops.py): the model only writes line edits, which
+# are applied to the original report
+EDIT_MAIN_PROMPT = """ 
+        You are a radiologist and you're given a numbered radiology report and some instructions to modify the report.  
+        Instead of the modified report, write only the line edits that make it, one per line, without other explanations or comments:
+        REPLACE <line>: <new sentence>, INSERT AFTER <line>: <new sentence>, APPEND FINDINGS: <new sentence>,
+        APPEND IMPRESSION: <new sentence> or DELETE <line>. Line numbers refer to the original report. Examples of input and output: 
+
+        Input:
+        Original report:\n
+        FINDINGS:\n1. Nasogastric tube has been advanced with the first side port in the proximal stomach. \nIMPRESSION:\n2. Nasogastric tube has been advanced. \n3. Overall no substantial change of the lungs. \n
+        Instructions: Instruction 1: Add \"No pulmonary nodules or masses are identified\" to the FINDINGS section. Instruction 2: Remove the last line.\n 
+
+        Output:
+        Edits:\n
+        INSERT AFTER 1: No pulmonary nodules or masses are identified.\n
+        DELETE 3
+
+        Input: Original report:\n 
+        FINDINGS:\n 1. The lung volumes are low. \n 2. Mild fullness in the right hila. \n 3. No pneumothorax or pleural effusion. \n
+        IMPRESSION:\n 4. Mild fullness in the right hila. \n
+
+        Instructions: Instruction 1: Change Line 2 and Line 4 from "right hila" to "left hila."\n
+
+        Output: Edits:\n 
+        REPLACE 2: Mild fullness in the left hila.\n
+        REPLACE 4: Mild fullness in the left hila.
+        """
+
+# bump when MAIN_PROMPT, EDIT_MAIN_PROMPT or the chat template change, invalidates the token cache
+PROMPT_TEMPLATE_VERSION = '1'
+
+def prompt_prefix(edit_mode=False):
+    # shared by every example
+    return create_chat_template([{"role": "system", "content": EDIT_MAIN_PROMPT if edit_mode else MAIN_PROMPT}])
+
+def prompt_suffix(instruction, original):
+    return create_chat_template([
+        {"role": "user", "content": ("Input: " + " Original report: " + original + "\nInstructions:" + instruction + "\nOutput: ")},
+    ])
+
+def build_prompt(instruction, original, edit_mode=False):
+    return prompt_prefix(edit_mode) + prompt_suffix(instruction, original)
+
+# the dataset columns run_inference reads
+DATA_COLUMNS = ['id', 'instructions', 'report_text', 'modified_text']
+
+def dataset_records(data):
+    # row dicts of the dataset. a columnar dataset (see generation/columnar.py) is read
+    # once, column by column, instead of decoding it again for every data[k]
+    if hasattr(data, 'rows'):
+        return data.rows(0, len(data), columns=[name for name in DATA_COLUMNS if name in data.column_names])
+    return data
+
+def build_prompts(data, edit_mode=False):
+    return [build_prompt(data[k]['instructions'], data[k]['report_text'], edit_mode) for k in range(len(data))]
+
+def prompt_width(tokenizer, prompts):
+    # padded prompt length of a batch, where generated tokens start
+    return max(len(ids) for ids in tokenizer(prompts)['input_ids'])
+
+def load_predictions(path):
+    # JSONL predictions written by run_inference, keyed by id. a line cut short by an
+    # interruption is ignored, its example is predicted again on resume
+    predictions = {}
+    if not os.path.exists(path):
+        return predictions
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            predictions[record['id']] = record
+    return predictions
+
+def append_predictions(path, records):
+    # one write per batch on a file opened for appending, so the lines of concurrent
+    # writers (see parallel.py) do not interleave
+    if not records:
+        return
+    text = ''.join(json.dumps(record) + '\n' for record in records)
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        # after an interruption mid-line, the new records start on a line of their own
+        size = os.fstat(fd).st_size
+        if size and os.pread(fd, 1, size - 1) != b'\n':
+            text = '\n' + text
+        os.write(fd, text.encode('utf-8'))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def load_pipeline(model_id, access_token=''):
 
-    if model_id=='meta-llama/Meta-Llama-3-8B-Instruct':
-        batch_size = 16
     if model_id in ['meta-llama/Meta-Llama-3-8B-Instruct', 'tiiuae/falcon-7b-instruct']:
         tokenizer = transformers.AutoTokenizer.from_pretrained(model_id, trust_remote_code=True, padding_side='left', token=access_token)
     else:
@@ -47,70 +161,159 @@ def run_inference(model_id, data, batch_size, access_token='', save=False):
     if pipeline.tokenizer.pad_token_id is None:
         pipeline.tokenizer.pad_token_id = pipeline.tokenizer.eos_token_id
 
-    main_prompt = """ 
-        You are a radiologist and you're given a radiology report and some instructions to modify the report,  
-        provide the modified report based on the instructions, without other explanations or comments. Examples of input and output: 
+    return pipeline
 
-        Input:
-        Original report:\n
-        FINDINGS:\n1. Nasogastric tube has been advanced with the first side port in the proximal stomach. \nIMPRESSION:\n2. Nasogastric tube has been advanced. \n3. Overall no substantial change of the lungs." \n
-        Instructions: Instruction 1: Add \"No pulmonary nodules or masses are identified\" to the FINDINGS section. Instruction 2: Remove the last line.\n 
+def run_inference(model_id, data, batch_size, access_token='', save=False, token_budget=0, prefix_cache=False,
+                  prompt_lookup=0, edit_mode=False, report_stopping=False, token_cache='', pipeline=None, prompts=None,
+                  predictions='', resume=False, append=False):
 
-        Output:
-        Modified Report:\n 
-        FINDINGS:\n1. Nasogastric tube has been advanced with the first side port in the proximal stomach. \n 2. No pulmonary nodules or masses are identified \nIMPRESSION:\n2. Nasogastric tube has been advanced."
+    if model_id=='meta-llama/Meta-Llama-3-8B-Instruct':
+        batch_size = 16
 
-        Input: Original report:\n 
-        FINDINGS:\n 1. The lung volumes are low. \n 2. Mild fullness in the right hila. \n 3. No pneumothorax or pleural effusion. \n
-        IMPRESSION:\n 4. Mild fullness in the right hila. \n
+    data = dataset_records(data)
 
-        Instructions: Instruction 1: Change Line 2 and Line 4 from "right hila" to "left hila."\n
+    # every batch is appended to the predictions file as it completes. on resume, examples
+    # whose id is already there are skipped and their recorded predictions returned. with
+    # append, the file is kept and added to without resuming from it
+    done = {}
+    if predictions:
+        if resume:
+            ids = [data[k]['id'] for k in range(len(data))]
+            if len(set(ids)) != len(ids):
+                raise ValueError("resume needs unique ids in the dataset")
+            done = load_predictions(predictions)
+        elif not append:
+            os.makedirs(os.path.dirname(predictions) or '.', exist_ok=True)
+            open(predictions, 'w').close()
+    todo = [k for k in range(len(data)) if data[k]['id'] not in done]
+    if done:
+        print(f"resuming from {predictions}: {len(data) - len(todo)} of {len(data)} examples already predicted")
 
-        Output: Modified Report:\n 
-        FINDINGS:\n 1. The lung volumes are low. \n 2. Mild fullness in the left hila. \n 3. No pneumothorax or pleural effusion. \n
-        IMPRESSION:\n 4. Mild fullness in the left hila. 
-        """
+    if edit_mode:
+        # edit scripts are applied by generation/edit_ops.py, only needed in edit mode
+        import generation_path
+        from edit_ops import apply_edit_script
+    if report_stopping:
+        from stopping import ReportStoppingCriteria, trim_output
 
+    # a pipeline loaded by the caller (see sweep.py) is used as is
+    if pipeline is None:
+        pipeline = load_pipeline(model_id, access_token)
+    tokenizer = pipeline.tokenizer
 
-    results = []
-    for i, (ids, instructions, originals, gts) in enumerate(tqdm(dataloader, total=len(dataloader), desc = f"generating with model {model_id}")):
-        batch_prompts = []
-        for instruction, original in zip(instructions, originals):
-            messages = [
-                {"role": "system", "content": main_prompt},
-                {"role": "user", "content": ("Input: " + " Original report: " + original + "\nInstructions:" + instruction + "\nOutput: ")},
-            ]
-            batch_prompts.append(create_chat_template(messages))
-        
-        if model_id == 'tiiuae/falcon-7b-instruct':
-            terminators = tokenizer.eos_token_id
-        else:
-            terminators = [
-                pipeline.tokenizer.eos_token_id,
-                pipeline.tokenizer.convert_tokens_to_ids("<|eot_id|>")
-            ]
+    if model_id == 'tiiuae/falcon-7b-instruct':
+        terminators = tokenizer.eos_token_id
+    else:
+        terminators = [
+            pipeline.tokenizer.eos_token_id,
+            pipeline.tokenizer.convert_tokens_to_ids("<|eot_id|>")
+        ]
+
+    if prompts is None:
+        prompts = build_prompts(data, edit_mode)
+
+    # token ids come from the disk cache, shared by every model with the same tokenizer
+    tokenized = None
+    if token_cache:
+        tokenized, hit = load_or_tokenize(tokenizer, prompts, token_cache, PROMPT_TEMPLATE_VERSION, model_id)
+        print(f"token cache {'hit' if hit else 'miss'}: {tokenized.path}")
+
+    # with a token budget, prompts of similar length are batched together, up to
+    # token_budget padded prompt tokens and batch_size rows per batch
+    # batches hold dataset indices of the examples left to predict
+    batches = [[todo[i] for i in batch] for batch in fixed_batches(len(todo), batch_size)]
+    if token_budget:
+        lengths = tokenized.lengths() if tokenized is not None else [len(ids) for ids in tokenizer(prompts)['input_ids']]
+        bucketed = [[todo[i] for i in batch] for batch in TokenBudgetBatchSampler([lengths[k] for k in todo], token_budget, batch_size).batches]
+        print(f"padding efficiency: {padding_efficiency(batches, lengths):.1%} in dataset order, "
+              f"{padding_efficiency(bucketed, lengths):.1%} length-bucketed ({len(batches)} -> {len(bucketed)} batches)")
+        batches = bucketed
+
+    generate_kwargs = dict(
+        # an edit script is a few lines, not the whole report
+        max_new_tokens=128 if edit_mode else 256,  
+        eos_token_id=terminators,
+        do_sample=True,
+        temperature=0.6,  
+        top_p=0.9,  
+        repetition_penalty=1.2
+    )
+
+    # prompt-lookup decoding: drafts of up to prompt_lookup tokens are copied from the prompt
+    # (mostly the original report, which the output largely repeats) and verified in one
+    # forward pass. assisted generation runs one example at a time
+    if prompt_lookup:
+        if prefix_cache:
+            raise ValueError("prompt_lookup and prefix_cache cannot be combined")
+        generate_kwargs['prompt_lookup_num_tokens'] = prompt_lookup
+
+    # the shared few-shot prefix is encoded once and its key/value cache reused for every batch
+    prefix = PrefixCache(pipeline.model, pipeline.tokenizer, prompt_prefix(edit_mode)) if prefix_cache else None
+
+    # rows stop as soon as their report is complete, see stopping.py
+    def stopping_criteria(rows, width=None):
+        if not report_stopping:
+            return {}
+        criteria = ReportStoppingCriteria(pipeline.tokenizer, [data[k]['report_text'] for k in rows],
+                                          [data[k]['instructions'] for k in rows], edit_mode, width)
+        return {'stopping_criteria': transformers.StoppingCriteriaList([criteria])}
+
+    results = {k: done[data[k]['id']] for k in range(len(data)) if data[k]['id'] in done}
+    n_edit_errors = 0
+    for batch in tqdm(batches, desc = f"generating with model {model_id}"):
+        batch_prompts = [prompts[k] for k in batch]
 
         # Batch inference
-        outputs = pipeline(
-            batch_prompts,
-            max_new_tokens=256,  
-            eos_token_id=terminators,
-            do_sample=True,
-            temperature=0.6,  
-            top_p=0.9,  
-            repetition_penalty=1.2,  
-            batch_size=batch_size 
-        )
-
-    for id, prompt, output, instruction, original, gt in zip(ids, batch_prompts, outputs, instructions, originals, gts):
-        res = {
-            'id': id,
-            'instructions': instruction,
-            'report_text': original,
-            'gt': gt,
-            'predicted': output[0]["generated_text"][len(prompt):]
-        }
-        results.append(res)
+        if prefix is not None:
+            predicted = prefix.generate([prompt_suffix(data[k]['instructions'], data[k]['report_text']) for k in batch],
+                                        **stopping_criteria(batch), **generate_kwargs)
+        elif prompt_lookup:
+            # assisted generation, one example per call
+            outputs = [pipeline([prompt], batch_size=1, **stopping_criteria([k], prompt_width(tokenizer, [prompt])),
+                                **generate_kwargs)[0] for k, prompt in zip(batch, batch_prompts)]
+            predicted = [output[0]["generated_text"][len(prompt):] for prompt, output in zip(batch_prompts, outputs)]
+        elif tokenized is not None:
+            # pre-tokenized prompts go straight to generate
+            input_ids, attention_mask = left_pad([tokenized[k] for k in batch], pipeline.tokenizer.pad_token_id)
+            input_ids = torch.from_numpy(input_ids).to(pipeline.model.device)
+            attention_mask = torch.from_numpy(attention_mask).to(pipeline.model.device)
+            with torch.no_grad():
+                outputs = pipeline.model.generate(input_ids=input_ids, attention_mask=attention_mask,
+                                                  pad_token_id=pipeline.tokenizer.pad_token_id,
+                                                  **stopping_criteria(batch, input_ids.shape[1]), **generate_kwargs)
+            predicted = pipeline.tokenizer.batch_decode(outputs[:, input_ids.shape[1]:], skip_special_tokens=True)
+        else:
+            outputs = pipeline(batch_prompts, batch_size=len(batch_prompts),
+                               **stopping_criteria(batch, prompt_width(tokenizer, batch_prompts)), **generate_kwargs)
+            predicted = [output[0]["generated_text"][len(prompt):] for prompt, output in zip(batch_prompts, outputs)]
+
+        if report_stopping:
+            predicted = [trim_output(prediction, data[k]['report_text'], data[k]['instructions'], edit_mode)
+                         for k, prediction in zip(batch, predicted)]
+
+        for k, prediction in zip(batch, predicted):
+            item = data[k]
+            results[k] = {
+                'id': item['id'],
+                'instructions': item['instructions'],
+                'report_text': item['report_text'],
+                'gt': item['modified_text'],
+                'predicted': prediction
+            }
+            if edit_mode:
+                # the reconstructed report is what postprocess and the metrics see
+                results[k]['edits'] = prediction
+                results[k]['predicted'], error = apply_edit_script(item['report_text'], prediction)
+                n_edit_errors += error is not None
+
+        if predictions:
+            append_predictions(predictions, [results[k] for k in batch])
+
+    if edit_mode:
+        print(f"{n_edit_errors} of {len(todo)} edit scripts did not apply, those reports are left unchanged")
+
+    # back in dataset order, whatever order the batches ran in
+    results = [results[k] for k in range(len(data))]
 
     if save:
         with open(f"{model_id.split('/')[1]}.json", 'w') as f:
@@ -118,20 +321,33 @@ def run_inference(model_id, data, batch_size, access_token='', save=False):
     
     return results
     
-def postprocess(model_id, results, out_dir = 'CXR-Report-Metric/reports/'):
-
-    predicted = pd.DataFrame(results)
-    predicted['id'] = predicted['id'].str.replace('.txt', '')
-    predicted['id'] = predicted['id'].str.replace('s', '')
+def study_ids(ids):
+    return ids.str.replace('.txt', '').str.replace('s', '')
 
-    gt = predicted[['id', 'gt']].copy()
+def write_gt_reports(results, out_dir = 'CXR-Report-Metric/reports/'):
+    gt = pd.DataFrame(results)[['id', 'gt']].copy()
+    gt['id'] = study_ids(gt['id'])
     gt.rename(columns={'id': 'study_id', 'gt': 'report'}, inplace=True)
     gt_file = os.path.join(out_dir, 'gt_reports.csv')
     gt.to_csv(gt_file, index=False)
+    return gt_file
+
+def postprocess(model_id, results, out_dir = 'CXR-Report-Metric/reports/', write_gt=True):
+
+    # results, or the path of a predictions file written by run_inference
+    if isinstance(results, str):
+        results = list(load_predictions(results).values())
+
+    predicted = pd.DataFrame(results)
+    predicted['id'] = study_ids(predicted['id'])
+
+    # the ground truth is the same for every model, a sweep writes it once
+    gt_file = write_gt_reports(results, out_dir) if write_gt else os.path.join(out_dir, 'gt_reports.csv')
 
     pred = predicted[['id', 'predicted']].copy()
     pred.rename(columns={'id': 'study_id', 'predicted': 'report'}, inplace=True)
     pred_file = os.path.join(out_dir, f'{model_id}_modified.csv')
+    os.makedirs(os.path.dirname(pred_file), exist_ok=True)
     pred.to_csv(pred_file, index=False)
 
     return gt_file, pred_file
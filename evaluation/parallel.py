@@ -0,0 +1,120 @@
+import os
+import time
+import queue as queue_module
+import traceback
+import multiprocessing as mp
+
+# data-parallel CPU inference: the dataset is sharded across worker processes, each loading
+# its own copy of the model with a fixed number of torch threads pinned to its own cores.
+# at small batch sizes a few processes with a few threads each keep more cores busy than
+# one process with all of them. results are merged back in dataset (id) order
+
+THREAD_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def core_layout(n_workers, threads_per_worker=0, cores=None):
+    # one block of consecutive cores per worker. threads_per_worker defaults to an even split
+    cores = available_cores() if cores is None else cores
+    threads_per_worker = threads_per_worker or max(1, len(cores) // n_workers)
+    if n_workers * threads_per_worker > len(cores):
+        raise ValueError(f"{n_workers} workers x {threads_per_worker} threads need more than the {len(cores)} available cores")
+    return [cores[r * threads_per_worker:(r + 1) * threads_per_worker] for r in range(n_workers)]
+
+def shard(n, n_workers):
+    # interleaved, so every shard gets a similar mix of report lengths
+    return [list(range(r, n, n_workers)) for r in range(n_workers)]
+
+def _worker(rank, cores, model_id, rows, batch_size, kwargs, queue):
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        import torch
+        torch.set_num_threads(len(cores))
+        torch.set_num_interop_threads(1)
+        from inference import load_pipeline, run_inference
+
+        start = time.perf_counter()
+        pipeline = load_pipeline(model_id, kwargs.get('access_token', ''))
+        load_time = time.perf_counter() - start
+        start = time.perf_counter()
+        results = run_inference(model_id, rows, batch_size, pipeline=pipeline, **kwargs)
+        queue.put((rank, results, (load_time, time.perf_counter() - start), None))
+    except Exception:
+        queue.put((rank, None, None, traceback.format_exc()))
+
+def run_parallel_inference(model_id, data, batch_size, n_workers, threads_per_worker=0, timings=None, **kwargs):
+    # same results as run_inference(model_id, data, batch_size, **kwargs), computed by
+    # n_workers processes. kwargs are passed on to run_inference in every worker.
+    # timings, when given, receives each worker's (load, inference) seconds
+    layout = core_layout(n_workers, threads_per_worker)
+
+    # a columnar dataset is read once here, rather than row by row into every shard. inference
+    # (and torch with it) is only imported by the workers
+    if hasattr(data, 'rows'):
+        data = data.rows(0, len(data))
+
+    # workers append to one predictions file. it is emptied here rather than by each of them,
+    # and on resume ids are checked over the whole dataset, a worker only sees its shard
+    if kwargs.get('predictions'):
+        if kwargs.get('resume'):
+            ids = [data[k]['id'] for k in range(len(data))]
+            if len(set(ids)) != len(ids):
+                raise ValueError("resume needs unique ids in the dataset")
+        else:
+            os.makedirs(os.path.dirname(kwargs['predictions']) or '.', exist_ok=True)
+            open(kwargs['predictions'], 'w').close()
+        kwargs['append'] = True
+    shards = shard(len(data), n_workers)
+    print(f"{n_workers} workers x {len(layout[0])} threads, cores {[f'{c[0]}-{c[-1]}' for c in layout]}")
+
+    # spawned workers start without the parent's thread pools. the thread count is also
+    # set through the environment, read by OpenMP and MKL when torch is imported
+    context = mp.get_context('spawn')
+    queue = context.Queue()
+    saved = {var: os.environ.get(var) for var in THREAD_VARS}
+    workers = []
+    try:
+        for rank, (cores, indices) in enumerate(zip(layout, shards)):
+            for var in THREAD_VARS:
+                os.environ[var] = str(len(cores))
+            worker = context.Process(target=_worker, args=(rank, cores, model_id, [data[k] for k in indices],
+                                                           batch_size, kwargs, queue))
+            worker.start()
+            workers.append(worker)
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+    # results are collected before joining, a worker blocks until its results are read
+    merged = {}
+    errors = []
+    for _ in workers:
+        while True:
+            try:
+                rank, results, times, error = queue.get(timeout=10)
+                break
+            except queue_module.Empty:
+                # a worker killed outright (e.g. out of memory) never reports
+                if not any(worker.is_alive() for worker in workers) and queue.empty():
+                    raise RuntimeError(f"parallel inference failed, exit codes {[worker.exitcode for worker in workers]}")
+        if error:
+            errors.append(f"worker {rank}:\n{error}")
+            continue
+        print(f"worker {rank}: {len(results)} examples, loaded in {times[0]:.0f}s, inference {times[1]:.0f}s")
+        if timings is not None:
+            timings.append(times)
+        for k, result in zip(shards[rank], results):
+            merged[k] = result
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise RuntimeError("parallel inference failed\n" + '\n'.join(errors))
+
+    return [merged[k] for k in range(len(data))]
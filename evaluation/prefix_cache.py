@@ -0,0 +1,91 @@
+import copy
+import time
+import argparse
+import torch
+from transformers import DynamicCache
+
+# run_inference prompts all start with the same few-shot block. PrefixCache runs that
+# prefix through the model once and hands a copy of its key/value cache to generate for
+# every batch, so only each example's suffix (report and instructions) is encoded.
+# suffixes are left-padded between the prefix and the suffix, and masked out
+
+class PrefixCache:
+
+    def __init__(self, model, tokenizer, prefix):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_ids = tokenizer(prefix, return_tensors='pt').input_ids.to(model.device)
+        with torch.no_grad():
+            cache = model(self.prefix_ids, use_cache=True).past_key_values
+        self.cache = DynamicCache.from_legacy_cache(cache) if isinstance(cache, tuple) else cache
+
+    def inputs(self, suffixes):
+        # prefix + padding + suffix for each row, the same token ids with or without the cache
+        suffix_ids = [self.tokenizer(s, add_special_tokens=False).input_ids for s in suffixes]
+        n_prefix = self.prefix_ids.shape[1]
+        width = n_prefix + max(len(ids) for ids in suffix_ids)
+        input_ids = torch.full((len(suffixes), width), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        input_ids[:, :n_prefix] = self.prefix_ids[0]
+        attention_mask[:, :n_prefix] = 1
+        for row, ids in enumerate(suffix_ids):
+            input_ids[row, width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, width - len(ids):] = 1
+        return input_ids.to(self.model.device), attention_mask.to(self.model.device)
+
+    def generate(self, suffixes, use_cache=True, **generate_kwargs):
+        # returns the decoded continuations, one per suffix
+        input_ids, attention_mask = self.inputs(suffixes)
+        if use_cache:
+            # generate extends the cache in place, so every call gets its own copy
+            cache = copy.deepcopy(self.cache)
+            if len(suffixes) > 1:
+                cache.batch_repeat_interleave(len(suffixes))
+            generate_kwargs['past_key_values'] = cache
+        with torch.no_grad():
+            outputs = self.model.generate(input_ids=input_ids, attention_mask=attention_mask,
+                                          pad_token_id=self.tokenizer.pad_token_id, **generate_kwargs)
+        return [self.tokenizer.decode(output[input_ids.shape[1]:], skip_special_tokens=True) for output in outputs]
+
+def check_equivalence(prefix_cache, pipeline, prefix, suffixes, batch_size=4, max_new_tokens=64):
+    # greedy outputs of the standard pipeline path (prefix + suffix as one prompt, tokenized
+    # together and left-padded) against PrefixCache.generate, which tokenizes them apart and
+    # pads between them. returns the mismatching suffixes and the time each path took
+    prompts = [prefix + suffix for suffix in suffixes]
+    start = time.perf_counter()
+    outputs = pipeline(prompts, batch_size=batch_size, do_sample=False, max_new_tokens=max_new_tokens,
+                       pad_token_id=pipeline.tokenizer.pad_token_id)
+    plain = [output[0]["generated_text"][len(prompt):] for prompt, output in zip(prompts, outputs)]
+    plain_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cached = []
+    for i in range(0, len(suffixes), batch_size):
+        cached += prefix_cache.generate(suffixes[i:i+batch_size], do_sample=False, max_new_tokens=max_new_tokens)
+    cached_time = time.perf_counter() - start
+
+    mismatches = [s for s, a, b in zip(suffixes, plain, cached) if a.strip() != b.strip()]
+    return mismatches, plain_time, cached_time
+
+if __name__ == '__main__':
+    import generation_path
+    from data_io import load_dataset
+    from inference import load_pipeline, prompt_prefix, prompt_suffix
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_id', type=str, help="Model ID on HF")
+    parser.add_argument('--data_path', type=str, default='../data/RadRevise_v0.csv')
+    parser.add_argument('--n', type=int, default=8, help="number of examples to compare")
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--max_new_tokens', type=int, default=64)
+    args = parser.parse_args()
+
+    data = load_dataset(args.data_path)
+    # the same pipeline (tokenizer, padding side, pad token) run_inference uses
+    pipeline = load_pipeline(args.model_id)
+    prefix_cache = PrefixCache(pipeline.model, pipeline.tokenizer, prompt_prefix())
+    suffixes = [prompt_suffix(data[k]['instructions'], data[k]['report_text']) for k in range(min(args.n, len(data)))]
+    mismatches, plain_time, cached_time = check_equivalence(prefix_cache, pipeline, prompt_prefix(), suffixes,
+                                                            args.batch_size, args.max_new_tokens)
+    print(f"prefix of {prefix_cache.prefix_ids.shape[1]} tokens, {len(suffixes)} examples: "
+          f"{plain_time:.1f}s with the pipeline, {cached_time:.1f}s with the prefix cache, {len(mismatches)} greedy mismatches")
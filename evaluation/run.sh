@@ -15,10 +15,6 @@ MODEL_IDS=(
     "epfl-llm/meditron-7b"
 )
 
-mkdir -p "$OUTPUT_DIR"
-
-for MODEL_ID in "${MODEL_IDS[@]}"
-do
-    OUTPUT_FILE="$OUTPUT_DIR/result_${MODEL_ID}.csv"
-    python eval_model "$MODEL_ID" "$DATA_PATH" "$BATCH_SIZE" "$OUTPUT_FILE"
-done
+# one process for all models: the dataset, prompts and ground-truth reports are prepared once,
+# results of every model are collected in $OUTPUT_DIR/sweep_results.csv
+python sweep.py --models "${MODEL_IDS[@]}" --data_path "$DATA_PATH" --batch_size "$BATCH_SIZE" --out_dir "$OUTPUT_DIR"
@@ -0,0 +1,106 @@
+import re
+import torch
+from transformers import StoppingCriteria
+
+import generation_path
+from response_parser import SECTION_HEADER, NUMBERED_LINE, REPORT_HEADER, INSTRUCTION_SPLIT
+from edit_ops import EDITS_HEADER, NO_CHANGES, parse_report, parse_edits
+
+# report-aware stopping for run_inference: a row stops as soon as its output holds a complete
+# modified report (or edit script) and moves on to something else, typically a new
+# "Input:" turn of the few-shot prompt, a chat role marker or commentary
+
+NEW_TURN = re.compile(r'(?i)^((input|output|instructions?|original report|user|system|assistant)\s*:|(example|note|explanation)\b)')
+
+def report_bounds(original, instruction):
+    # (lines in the original, number of instructions, whether it has an IMPRESSION section).
+    # each instruction adds or removes a few lines at most, which bounds the output's length
+    sections = parse_report(original)
+    n_lines = sum(len(sentences) for _, sentences in sections)
+    n_inst = max(len(INSTRUCTION_SPLIT.findall(instruction)), 1)
+    return n_lines, n_inst, any(section == 'IMPRESSION' for section, _ in sections)
+
+def report_end(text, n_lines, n_inst, has_impression, edit_mode=False):
+    # offset in text where the output stops being the report (or edit script), or None
+    # while it may still continue. only complete lines are looked at
+    sentences = 0
+    in_impression = False
+    offset = 0
+    for line in text.split('\n')[:-1]:
+        start = offset
+        offset += len(line) + 1
+        line = line.strip()
+
+        if edit_mode:
+            if not line or EDITS_HEADER.match(line):
+                continue
+            if NO_CHANGES.match(line):
+                return offset
+            if parse_edits(line)[0]:
+                sentences += 1
+                if sentences > n_lines + 2 * n_inst:
+                    return start
+                continue
+            if sentences or NEW_TURN.match(line):
+                return start
+            continue
+
+        if not line:
+            # a blank line after the last section, once the report is long enough
+            if sentences >= n_lines - n_inst and (in_impression or not has_impression):
+                return start
+            continue
+        if REPORT_HEADER.match(line):
+            line = line[REPORT_HEADER.match(line).end():].strip()
+            if not line:
+                continue
+        header = SECTION_HEADER.match(line)
+        if header:
+            in_impression = header.group(1).upper().startswith('I')
+            line = header.group(2).strip()
+            if not line:
+                continue
+        if NUMBERED_LINE.match(line):
+            sentences += 1
+            if sentences > n_lines + 2 * n_inst:
+                return start
+            continue
+        if sentences and (NEW_TURN.match(line) or sentences >= n_lines - n_inst):
+            return start
+    return None
+
+class ReportStoppingCriteria(StoppingCriteria):
+    # per-row stopping: returns a bool per row, finished rows only receive padding from then on.
+    # prompt_width is where generated tokens start; without it, it is taken at the first call,
+    # which comes after exactly one generated token
+
+    def __init__(self, tokenizer, originals, instructions, edit_mode=False, prompt_width=None):
+        self.tokenizer = tokenizer
+        self.bounds = [report_bounds(original, instruction) for original, instruction in zip(originals, instructions)]
+        self.edit_mode = edit_mode
+        self.prompt_width = prompt_width
+        self.done = None
+        self.checked = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            if self.prompt_width is None:
+                self.prompt_width = input_ids.shape[1] - 1
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+            self.checked = self.prompt_width
+
+        new_tokens = input_ids[:, self.checked:]
+        self.checked = input_ids.shape[1]
+        for row in range(input_ids.shape[0]):
+            # the structure only changes when a line is completed
+            if self.done[row] or '\n' not in self.tokenizer.decode(new_tokens[row]):
+                continue
+            text = self.tokenizer.decode(input_ids[row, self.prompt_width:], skip_special_tokens=True)
+            if report_end(text, *self.bounds[row], self.edit_mode) is not None:
+                self.done[row] = True
+        return self.done.clone()
+
+def trim_output(text, original, instruction, edit_mode=False):
+    # drops whatever follows the report, the line that stopped generation included
+    end = report_end(text, *report_bounds(original, instruction), edit_mode)
+    return text if end is None else text[:end].rstrip()
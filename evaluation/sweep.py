@@ -0,0 +1,160 @@
+import os
+import gc
+import time
+import ctypes
+import argparse
+import pandas as pd
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from CXRMetric.run_eval import calc_metric
+
+import generation_path
+from data_io import load_dataset
+from inference import (load_pipeline, run_inference, build_prompts, postprocess, write_gt_reports, load_predictions,
+                       dataset_records)
+
+# evaluates several models in one process: the dataset, prompts and ground-truth reports are
+# prepared once, models are loaded, run and released one after the other (or a few small ones
+# at a time when --ram_gb allows), and the metrics of all models end up in one table
+
+MODEL_IDS = [
+    "meta-llama/Meta-Llama-3-8B-Instruct",
+    "mistralai/MMistral-7B-Instruct-v0.3",
+    "microsoft/Phi-3-mini-128k-instruct",
+    "tiiuae/falcon-7b-instruct",
+    "AdaptLLM/medicine-chat",
+    "ruslanmv/Medical-Llama3-8B",
+    "epfl-llm/meditron-7b",
+]
+
+# loaded weights plus activations and the KV cache, relative to the checkpoint size
+MEMORY_OVERHEAD = 1.3
+
+def release_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    # hand freed heap pages back to the OS, so the next model has the RAM
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def model_size_gb(model_id, access_token=''):
+    # checkpoint size on the hub, None when it cannot be looked up
+    try:
+        from huggingface_hub import HfApi
+        info = HfApi().model_info(model_id, files_metadata=True, token=access_token or None)
+    except Exception:
+        return None
+    sizes = {'.safetensors': 0, '.bin': 0}
+    for sibling in info.siblings:
+        for suffix in sizes:
+            if sibling.rfilename.endswith(suffix):
+                sizes[suffix] += sibling.size or 0
+    # repositories often ship both formats, only one is loaded
+    return (sizes['.safetensors'] or sizes['.bin']) / 1e9 or None
+
+def schedule(model_ids, ram_gb, max_concurrent, access_token=''):
+    # groups consecutive models into waves that fit in ram_gb together. models of unknown
+    # size, and every model when ram_gb is 0, run alone
+    if not ram_gb or max_concurrent <= 1:
+        return [[model_id] for model_id in model_ids]
+    waves = []
+    wave = []
+    used = 0
+    for model_id in model_ids:
+        size = model_size_gb(model_id, access_token)
+        need = size * MEMORY_OVERHEAD if size else None
+        alone = need is None or need > ram_gb
+        if wave and (alone or used + need > ram_gb or len(wave) >= max_concurrent):
+            waves.append(wave)
+            wave = []
+            used = 0
+        if alone:
+            waves.append([model_id])
+            continue
+        wave.append(model_id)
+        used += need
+    if wave:
+        waves.append(wave)
+    return waves
+
+def infer(model_id, data, prompts, args):
+    # predictions are kept in out_dir as they are made, so an interrupted sweep resumes
+    predictions = os.path.join(args.out_dir, f"predictions_{model_id.replace('/', '_')}.jsonl")
+    if args.resume:
+        done = load_predictions(predictions)
+        if all(data[k]['id'] in done for k in range(len(data))):
+            print(f"{model_id}: every example already predicted in {predictions}")
+            return [done[data[k]['id']] for k in range(len(data))], 0, 0
+
+    start = time.perf_counter()
+    pipeline = load_pipeline(model_id, args.access_token)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = run_inference(model_id, data, args.batch_size, token_budget=args.token_budget, prefix_cache=args.prefix_cache,
+                            prompt_lookup=args.prompt_lookup, edit_mode=args.edit_mode,
+                            report_stopping=args.report_stopping, token_cache=args.token_cache,
+                            pipeline=pipeline, prompts=prompts, predictions=predictions, resume=args.resume)
+    inference_time = time.perf_counter() - start
+
+    del pipeline
+    release_memory()
+    return results, load_time, inference_time
+
+def main(args):
+    data = dataset_records(load_dataset(args.data_path))
+    prompts = build_prompts(data, args.edit_mode)
+    os.makedirs(args.out_dir, exist_ok=True)
+    os.makedirs(args.reports_dir, exist_ok=True)
+    write_gt_reports([{'id': data[k]['id'], 'gt': data[k]['modified_text']} for k in range(len(data))], args.reports_dir)
+
+    waves = schedule(args.models, args.ram_gb, args.max_concurrent, args.access_token)
+    print(f"{len(args.models)} models in {len(waves)} waves: {waves}")
+
+    rows = []
+    n_threads = torch.get_num_threads()
+    for wave in waves:
+        # concurrent models share the cores
+        torch.set_num_threads(max(1, n_threads // len(wave)))
+        with ThreadPoolExecutor(len(wave)) as executor:
+            runs = list(executor.map(lambda model_id: infer(model_id, data, prompts, args), wave))
+        torch.set_num_threads(n_threads)
+
+        # metrics one model at a time, after the wave's models are released
+        for model_id, (results, load_time, inference_time) in zip(wave, runs):
+            gt_file, pred_file = postprocess(model_id, results, args.reports_dir, write_gt=False)
+            out_file = os.path.join(args.out_dir, f"result_{model_id.replace('/', '_')}.csv")
+            calc_metric(gt_file, pred_file, out_file, False)
+
+            scores = pd.read_csv(out_file).mean(numeric_only=True)
+            rows.append({'model_id': model_id, 'load_s': round(load_time, 1), 'inference_s': round(inference_time, 1),
+                         'concurrent': len(wave), **scores.to_dict()})
+            print(f"{model_id}: loaded in {load_time:.0f}s, inference {inference_time:.0f}s")
+
+    table = pd.DataFrame(rows)
+    table.to_csv(os.path.join(args.out_dir, 'sweep_results.csv'), index=False)
+    print(table.to_string(index=False))
+    return table
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=str, nargs='+', default=MODEL_IDS, help="Model IDs on HF")
+    parser.add_argument('--data_path', type=str, default='../data/RadRevise_v0.csv', help="RadRevise dataset")
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--out_dir', type=str, default='output/', help="per-model results and sweep_results.csv")
+    parser.add_argument('--reports_dir', type=str, default='CXR-Report-Metric/reports/')
+    parser.add_argument('--access_token', type=str, default='')
+    parser.add_argument('--ram_gb', type=float, default=0, help="run small models concurrently within this much RAM, 0 runs one at a time")
+    parser.add_argument('--max_concurrent', type=int, default=2, help="most models loaded at once")
+    parser.add_argument('--token_budget', type=int, default=0)
+    parser.add_argument('--prefix_cache', action='store_true')
+    parser.add_argument('--prompt_lookup', type=int, default=0)
+    parser.add_argument('--edit_mode', action='store_true')
+    parser.add_argument('--report_stopping', action='store_true')
+    parser.add_argument('--token_cache', type=str, default='')
+    parser.add_argument('--resume', action='store_true', help="keep the predictions already in out_dir and only make the missing ones")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,92 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+# disk-backed cache of tokenized prompts for run_inference. token ids of all prompts are
+# concatenated in one memory-mapped int32 array, with an offsets array marking where each
+# prompt starts, so token lengths for length-bucketing come for free and batches are built
+# without tokenizing. the cache key combines the tokenizer's fingerprint (vocabulary,
+# special tokens and how it adds them, not its model name, so models sharing a tokenizer
+# share the cache), the prompt template version and the prompts themselves
+
+CHUNK_SIZE = 1024
+
+def tokenizer_fingerprint(tokenizer):
+    vocab = sorted(tokenizer.get_vocab().items())
+    payload = json.dumps([type(tokenizer).__name__, vocab, tokenizer.special_tokens_map,
+                          tokenizer('a')['input_ids']], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def cache_key(fingerprint, template_version, prompts):
+    h = hashlib.sha256(f"{fingerprint}/{template_version}".encode('utf-8'))
+    for prompt in prompts:
+        h.update(hashlib.sha256(prompt.encode('utf-8')).digest())
+    return h.hexdigest()
+
+class TokenizedPrompts:
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, k):
+        return self.ids[self.offsets[k]:self.offsets[k + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets).tolist()
+
+def write_tokenized(path, tokenizer, prompts, meta):
+    # written to a temporary directory and renamed, so a cache entry is either complete or absent
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    chunks = []
+    lengths = []
+    for i in range(0, len(prompts), CHUNK_SIZE):
+        for ids in tokenizer(prompts[i:i + CHUNK_SIZE])['input_ids']:
+            chunks.append(np.asarray(ids, dtype=np.int32))
+            lengths.append(len(ids))
+    offsets = np.zeros(len(prompts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    np.save(os.path.join(tmp_path, 'ids.npy'), np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32))
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({**meta, 'n_prompts': len(prompts), 'n_tokens': int(offsets[-1])}, f, indent=4)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process wrote the same entry first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def load_or_tokenize(tokenizer, prompts, cache_dir, template_version, model_id=''):
+    # returns (TokenizedPrompts, hit)
+    fingerprint = tokenizer_fingerprint(tokenizer)
+    path = os.path.join(cache_dir, cache_key(fingerprint, template_version, prompts))
+    hit = os.path.exists(os.path.join(path, 'meta.json'))
+    if not hit:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_tokenized(path, tokenizer, prompts, {
+            'tokenizer': getattr(tokenizer, 'name_or_path', ''),
+            'model_id': model_id,
+            'revision': getattr(tokenizer, 'init_kwargs', {}).get('revision', ''),
+            'vocab_hash': fingerprint,
+            'template_version': template_version
+        })
+    return TokenizedPrompts(path), hit
+
+def left_pad(rows, pad_token_id):
+    # [token ids] -> (input_ids, attention_mask) arrays, padded on the left for generation
+    width = max(len(ids) for ids in rows)
+    input_ids = np.full((len(rows), width), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(rows), width), dtype=np.int64)
+    for row, ids in enumerate(rows):
+        input_ids[row, width - len(ids):] = ids
+        attention_mask[row, width - len(ids):] = 1
+    return input_ids, attention_mask
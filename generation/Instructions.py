@@ -1,9 +1,104 @@
 import random
 import re
-from utils import InstType, Location, Topic
+import numpy as np
+from utils import InstType, Location, Topic, topic_variants
+
+# instruction types whose prompt names no topic
+NO_TOPIC_INST = {InstType.RM_OBS, InstType.CHG_OBS, InstType.CHG_LOC_OF_OBS, 
+                 InstType.CHG_SHAPE_OF_OBS, InstType.CHG_CERTAINTY, InstType.CHG_SEVERITY}
+# same, but the instruction only applies if the report has one
+IF_ANY_INST = {InstType.CHG_COMPS_TO_PRIOR, InstType.RM_COMPS_TO_PRIOR, 
+               InstType.RM_REC, InstType.CHG_REC}
+
+class AliasTable:
+    # Vose's alias method: O(n) setup, O(1) weighted draws
+    def __init__(self, weights):
+        n = len(weights)
+        total = sum(weights)
+        self.n = n
+        self.prob = [0.0] * n
+        self.alias = list(range(n))
+
+        scaled = [w * n / total for w in weights] if total > 0 else []
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1
+            (small if scaled[l] < 1 else large).append(l)
+        for i in small + large:
+            self.prob[i] = 1.0
+
+        self.prob_array = np.array(self.prob)
+        self.alias_array = np.array(self.alias)
+
+    def draw(self, rng=random):
+        i = rng.randrange(self.n)
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+    def draw_many(self, k, rng):
+        # rng is a numpy Generator
+        i = rng.integers(0, self.n, size=k)
+        return np.where(rng.random(k) < self.prob_array[i], i, self.alias_array[i])
+
+class TopicIndex:
+    # finds every Topic mentioned in a report in one pass. all Topic values and
+    # topic_variants entries are compiled into one lookahead alternation, longest first,
+    # so the regex engine reports the longest pattern starting at every position, and
+    # shorter patterns that are prefixes of it are added from a precomputed closure.
+    # matching is case-insensitive substring matching, like search_report
+
+    def __init__(self):
+        self.pattern_topics = {}
+        for topic in Topic:
+            for pattern in [topic.value] + topic_variants.get(topic, []):
+                self.pattern_topics.setdefault(pattern.lower(), set()).add(topic)
+
+        patterns = sorted(self.pattern_topics, key=len, reverse=True)
+        self.closure = {}
+        for pattern in patterns:
+            topics = set()
+            for other in patterns:
+                if pattern.startswith(other):
+                    topics |= self.pattern_topics[other]
+            self.closure[pattern] = frozenset(topics)
+
+        self.regex = re.compile('(?=(' + '|'.join(re.escape(p) for p in patterns) + '))')
+        self.header = re.compile(r'(FINDINGS:|IMPRESSION:)')
+
+    def find(self, text):
+        # set of Topics mentioned anywhere in text
+        topics = set()
+        for match in self.regex.finditer(text.lower()):
+            topics |= self.closure[match.group(1)]
+        return topics
+
+    def find_sections(self, report):
+        # {'report': topics, 'findings': topics, 'impression': topics} for a clean_text
+        # formatted report, still a single scan over the text
+        lowered = report.lower()
+        boundaries = [(m.start(), m.group(1)) for m in self.header.finditer(report)]
+        found = {'report': set(), 'findings': set(), 'impression': set()}
+        b = -1
+        for match in self.regex.finditer(lowered):
+            while b + 1 < len(boundaries) and boundaries[b + 1][0] <= match.start():
+                b += 1
+            topics = self.closure[match.group(1)]
+            found['report'] |= topics
+            if b >= 0:
+                found['findings' if boundaries[b][1] == 'FINDINGS:' else 'impression'] |= topics
+        return found
+
+# section of the report an instruction at this location has to be grounded in
+LOCATION_SECTION = {
+    Location.SECTION_FIND: 'findings',
+    Location.SECTION_IMPR: 'impression',
+}
 
 class Instructions:
-    def __init__(self, seed = None, inst_type_weights={}, location_weights={}, topic_weights={}):
+    def __init__(self, seed = None, inst_type_weights={}, location_weights={}, topic_weights={}, topic_aware=False):
         self.inst_types = list(InstType)
         self.locations = list(Location)
         self.topics = list(Topic)
@@ -13,6 +108,11 @@ class Instructions:
         self.topic_weights = topic_weights if len(topic_weights) else {top: 1 for top in Topic}
 
         self.inst_list = self._make_inst()
+        self._build_sampler()
+
+        # topic-aware mode grounds RM/CHG instructions in topics the report mentions
+        self.topic_aware = topic_aware
+        self.topic_index = TopicIndex() if topic_aware else None
 
         self.seed = seed
     
@@ -20,7 +120,7 @@ class Instructions:
 
         if inst_type_weights:
             for k, v in inst_type_weights.items():
-                assert k in self.inst_type
+                assert k in self.inst_types
                 self.inst_type_weights[k] = v
 
         if location_weights:
@@ -33,6 +133,63 @@ class Instructions:
                 assert k in self.topics
                 self.topic_weights[k] = v
 
+        self._build_sampler()
+
+    def _build_sampler(self):
+
+        # flatten every valid (inst_type, location, topic) triple with the probability the
+        # rejection sampler gave it: inst_type by weight, location by weight among all
+        # locations, topic by weight among the valid topics of (inst_type, location).
+        # (inst_type, location) pairs without valid topics are dropped and the rest
+        # renormalized, which is exactly what rejecting and redrawing did
+        self.triples = []
+        weights = []
+        location_total = sum(self.location_weights[loc] for loc in self.locations)
+
+        for inst_type in self.inst_types:
+            type_weight = self.inst_type_weights[inst_type]
+            if not type_weight:
+                continue
+            for location in self.locations:
+                loc_weight = self.location_weights[location]
+                if not loc_weight:
+                    continue
+                weight = type_weight * loc_weight / location_total
+
+                if inst_type in NO_TOPIC_INST or inst_type in IF_ANY_INST:
+                    self.triples.append((inst_type, location, None))
+                    weights.append(weight)
+                    continue
+
+                topics = [t for t in self.inst_list[inst_type][location] if self.topic_weights[t]]
+                topic_total = sum(self.topic_weights[t] for t in topics)
+                for topic in topics:
+                    self.triples.append((inst_type, location, topic))
+                    weights.append(weight * self.topic_weights[topic] / topic_total)
+
+        self.triple_weights = weights
+        self.sampler = AliasTable(weights)
+
+        # for topic-aware sampling: instructions that need no grounding keep their weights,
+        # the RM/CHG ones get a topic among the valid topics of (inst_type, location) that
+        # the report mentions, so their weight can only be known per report
+        self.static_triples = []
+        static_weights = []
+        for triple, weight in zip(self.triples, weights):
+            if triple[0] not in NO_TOPIC_INST:
+                self.static_triples.append(triple)
+                static_weights.append(weight)
+        self.static_weight = sum(static_weights)
+        self.static_sampler = AliasTable(static_weights)
+
+        self.grounded_pairs = []
+        for inst_type, location, _ in self.triples:
+            if inst_type in NO_TOPIC_INST:
+                valid = {t for t in self.inst_list[inst_type][location] if self.topic_weights[t]}
+                if valid:
+                    pair_weight = self.inst_type_weights[inst_type] * self.location_weights[location] / location_total
+                    self.grounded_pairs.append((inst_type, location, valid, pair_weight))
+
 
     def _make_inst(self):
 
@@ -121,103 +278,97 @@ class Instructions:
         return topic.lower() in impression.lower()
 
 
-    def get_single_inst(self, report):
-
+    def _rng(self, rng):
+        # explicit random.Random streams keep sampling independent of call order.
+        # with a fixed seed every call starts from the same state, without touching
+        # the global `random` module
         if self.seed:
-            random.seed(self.seed)
-
-        found = False
-        tries = 0 
-        res = ""
-
-        while not found and tries < 100:
-            tries += 1
-            
-            # randomly choose instruction type
-            inst_type = random.choices(
-                self.inst_types, 
-                weights=[self.inst_type_weights[i] for i in self.inst_types], 
-                k=1)[0]
-
-            # get possible locations
-            locations = list(self.inst_list.get(inst_type).keys())
-
-            if not locations:
-                continue 
-
-            # randomly choose location
-            location = random.choices(
-                locations, 
-                weights=[self.location_weights[loc] for loc in locations], 
-                k=1)[0]
-
-            if inst_type not in {
-                InstType.ADD_COMPS_TO_PRIOR, InstType.ADD_OBS, InstType.ADD_REC
-            }:
-                if location == Location.SECTION_FIND and "findings:" not in report.lower():
-                    location = Location.SECTION_IMPR
-                elif location == Location.SECTION_IMPR and "impression:" not in report.lower():
-                    location = Location.SECTION_FIND
-
-            # for certain instructions, check existence of topics
-            if inst_type in {InstType.RM_OBS, InstType.CHG_OBS, InstType.CHG_LOC_OF_OBS, 
-                             InstType.CHG_SHAPE_OF_OBS, InstType.CHG_CERTAINTY, InstType.CHG_SEVERITY}:
-
-                res = f"an instruction to {inst_type.value} {location.value}" 
-                found = True
-
-            elif (inst_type in {InstType.CHG_COMPS_TO_PRIOR, InstType.RM_COMPS_TO_PRIOR, 
-                                InstType.RM_REC, InstType.CHG_REC}):
-                res = f"an instruction to {inst_type.value} {location.value}, if any" 
-                found = True
-
-            elif inst_type in { InstType.ADD_REC, InstType.ADD_COMPS_TO_PRIOR}:
-                topics = self.inst_list.get(inst_type).get(location)
-                if topics:
-                    topic = random.choices(
-                        topics, 
-                        weights=[self.topic_weights[t] for t in topics], 
-                        k=1)[0]
-                    found = True
-
-            elif inst_type in {InstType.ADD_OBS} :
-                topics = self.inst_list.get(inst_type).get(location)
-                if topics:
-                    topic = random.choices(
-                        topics, 
-                        weights=[self.topic_weights[t] for t in topics], 
-                        k=1)[0]
-                    found= True
-        
-                # topics_sub = []
-                # for t in topics:
-                #     if location in {Location.SECTION_FIND, Location.SECTION_IMPR}:
-                #         mentioned = self.search_report(report, t, location.value)
-                #     else:
-                #         mentioned = self.search_report(report, t)
-
-                #     if mentioned:
-                #         topics_sub.append(t)
-
-                # if topics_sub: 
-                #     found = True
-                #     topics = topics_sub
-
-
-        if tries == 100 and not found:
+            return random.Random(self.seed)
+        return rng if rng is not None else random
+
+    def sample(self, n, rng=None):
+
+        # draw n (inst_type, location, topic) triples at once, topic is None for
+        # instruction types that name no topic. the numpy generator doing the draws
+        # is seeded from rng (a random.Random, or the `random` module by default)
+        if not self.triples:
+            return []
+        np_rng = np.random.default_rng(self._rng(rng).getrandbits(64))
+        return [self.triples[i] for i in self.sampler.draw_many(n, np_rng)]
+
+    def format_inst(self, inst_type, location, topic, report):
+
+        if inst_type not in {
+            InstType.ADD_COMPS_TO_PRIOR, InstType.ADD_OBS, InstType.ADD_REC
+        }:
+            if location == Location.SECTION_FIND and "findings:" not in report.lower():
+                location = Location.SECTION_IMPR
+            elif location == Location.SECTION_IMPR and "impression:" not in report.lower():
+                location = Location.SECTION_FIND
+
+        if inst_type in NO_TOPIC_INST:
+            return f"an instruction to {inst_type.value} {location.value}" 
+
+        if inst_type in IF_ANY_INST:
+            return f"an instruction to {inst_type.value} {location.value}, if any" 
+
+        assert (inst_type in self.inst_types and location in self.locations 
+                and topic in self.topics) 
+        return f"an instruction to {inst_type.value} {location.value} about {topic.value}" 
+
+    def grounded_candidates(self, mentions):
+
+        # (triple, weight) for every RM/CHG instruction whose topic is mentioned in the
+        # section its location refers to. the pair keeps its weight and the topic is
+        # drawn among the mentioned valid topics, as the commented-out filter intended
+        candidates = []
+        for inst_type, location, valid, pair_weight in self.grounded_pairs:
+            topics = [t for t in mentions[LOCATION_SECTION.get(location, 'report')] if t in valid]
+            if not topics:
+                continue
+            topic_total = sum(self.topic_weights[t] for t in topics)
+            for topic in sorted(topics, key=lambda t: t.name):
+                candidates.append(((inst_type, location, topic), pair_weight * self.topic_weights[topic] / topic_total))
+        return candidates
+
+    def format_grounded_inst(self, inst_type, location, topic):
+        return f"an instruction to {inst_type.value} {location.value} about {topic.value}"
+
+    def get_single_inst(self, report, candidates=None, rng=None):
+
+        rng = self._rng(rng)
+
+        if self.topic_aware:
+            if candidates is None:
+                candidates = self.grounded_candidates(self.topic_index.find_sections(report))
+            total = self.static_weight + sum(w for _, w in candidates)
+            if not total:
+                return None
+            r = rng.random() * total
+            if r >= self.static_weight:
+                r -= self.static_weight
+                for (inst_type, location, topic), weight in candidates:
+                    r -= weight
+                    if r < 0:
+                        break
+                return self.format_grounded_inst(inst_type, location, topic)
+            inst_type, location, topic = self.static_triples[self.static_sampler.draw(rng)]
+            return self.format_inst(inst_type, location, topic, report)
+
+        # every entry of the alias table is a valid instruction, so there are no rejected draws
+        if not self.triples:
             return None
 
-        if not res: 
-            assert (inst_type in self.inst_types and location in self.locations 
-                    and topic in self.topics) 
-            res = f"an instruction to {inst_type.value} {location.value} about {topic.value}" 
-        return res
+        inst_type, location, topic = self.triples[self.sampler.draw(rng)]
+        return self.format_inst(inst_type, location, topic, report)
 
-    def get_insts(self, report, n=1, inst_types=[], levels=[], topics=[]):
+    def get_insts(self, report, n=1, inst_types=[], levels=[], topics=[], rng=None):
 
+        # the report is indexed once for all n instructions
+        candidates = self.grounded_candidates(self.topic_index.find_sections(report)) if self.topic_aware else None
         included = []
         for _ in range(n):
-            inst = self.get_single_inst(report)
+            inst = self.get_single_inst(report, candidates, rng)
             if inst and inst not in included:
                 included.append(inst) 
         
@@ -0,0 +1,176 @@
+import time
+import httpx
+import asyncio
+import openai
+from openai import AsyncAzureOpenAI
+
+from utils import (API_KEY, API_VERSION, GPT_MODEL, AZURE_ENDPOINT, DEFAULT_RETRY_POLICY, QueryError,
+                   build_messages, estimate_cost, estimate_prompt_tokens)
+from response_parser import ResponseParser, parse_response
+
+def estimate_tokens(messages, max_tokens):
+    # rough pre-request estimate plus the completion budget, used to charge the
+    # tokens-per-minute limiter before the real usage is known
+    return estimate_prompt_tokens(messages) + max_tokens
+
+class RateLimiter:
+    # continuously refilling token bucket holding at most one minute of budget
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.available = per_minute
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        if not self.per_minute:
+            return
+        # a single request larger than the whole budget still goes through once the bucket is full
+        amount = min(amount, self.per_minute)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(self.per_minute, self.available + (now - self.updated) * self.per_minute / 60)
+                self.updated = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                await asyncio.sleep((amount - self.available) * 60 / self.per_minute)
+
+    def pause(self, seconds):
+        # after a 429, drain the bucket so no request starts before the server asked
+        self.available = -seconds * self.per_minute / 60 if self.per_minute else 0
+        self.updated = time.monotonic()
+
+class AsyncEngine:
+    # keeps up to max_in_flight chat completion requests open, throttled by
+    # requests-per-minute and tokens-per-minute budgets, and returns results in job order.
+    # with stream=True completions are parsed as they arrive and closed early, like query_openai_stream
+
+    def __init__(self, max_in_flight=16, requests_per_minute=0, tokens_per_minute=0,
+                 retry_policy=DEFAULT_RETRY_POLICY, api_key=API_KEY, azure_endpoint=AZURE_ENDPOINT, model=GPT_MODEL, cache=None,
+                 stream=False, edit_mode=False):
+        self.max_in_flight = max_in_flight
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.retry_policy = retry_policy
+        self.api_key = api_key
+        self.azure_endpoint = azure_endpoint
+        self.model = model
+        self.cache = cache
+        self.stream = stream
+        self.edit_mode = edit_mode
+
+    async def _query(self, client, semaphore, request_limiter, token_limiter, instructions, report, max_tokens, temperature):
+        messages = build_messages(instructions, report, self.edit_mode)
+        if self.cache is not None:
+            key = self.cache.key(messages, self.model, max_tokens, temperature, stream=self.stream)
+            completion = self.cache.get(key)
+            if completion is not None:
+                if self.stream:
+                    return completion, 0, {**parse_response(completion), 'aborted': False, 'ttft': None, 'latency': None}
+                return completion, 0
+
+        async with semaphore:
+            for attempt in range(self.retry_policy.max_retries + 1):
+                await request_limiter.acquire()
+                await token_limiter.acquire(estimate_tokens(messages, max_tokens))
+                try:
+                    if self.stream:
+                        result = await self._stream(client, messages, max_tokens, temperature)
+                    else:
+                        response = await client.chat.completions.create(
+                            model=self.model,
+                            messages=messages,
+                            max_tokens=max_tokens,
+                            temperature=temperature
+                        )
+                except Exception as e:
+                    if not self.retry_policy.is_retryable(e) or attempt == self.retry_policy.max_retries:
+                        raise self.retry_policy.to_query_error(e, attempt + 1) from e
+                    delay = self.retry_policy.delay(attempt, e)
+                    if isinstance(e, openai.RateLimitError):
+                        # hold back every other request too, not only this one
+                        request_limiter.pause(delay)
+                        token_limiter.pause(delay)
+                    await asyncio.sleep(delay)
+                    continue
+
+                if self.stream:
+                    # only a stream that ran to its end with a valid reply is a full completion
+                    if self.cache is not None and result[2]['valid'] and not result[2]['aborted']:
+                        self.cache.put(key, result[0], result[1])
+                    return result
+
+                completion = response.choices[0].message.content
+                cost = estimate_cost(response.usage.prompt_tokens, response.usage.completion_tokens)
+                if self.cache is not None:
+                    self.cache.put(key, completion, cost)
+                return completion, cost
+
+    async def _stream(self, client, messages, max_tokens, temperature):
+        parser = ResponseParser()
+        start = time.perf_counter()
+        ttft = None
+        aborted = False
+        stream = await client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True
+        )
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                if parser.feed(delta):
+                    aborted = True
+                    break
+        finally:
+            await stream.close()
+
+        parsed = {**parser.finish(), 'aborted': aborted, 'ttft': ttft, 'latency': time.perf_counter() - start}
+        # streamed responses carry no usage, so the cost is estimated from the text
+        cost = estimate_cost(estimate_prompt_tokens(messages), len(parser.text) // 4)
+        return parser.text, cost, parsed
+
+    async def run(self, jobs, max_tokens=500, temperature=.4, on_result=None):
+        # jobs is a list of (instructions, report). on_result(i, (completion, cost)), or
+        # (completion, cost, parsed) when streaming, is called as soon as each request finishes, which is not necessarily in order.
+        # a job that fails for good yields its QueryError instead of a result
+        client = AsyncAzureOpenAI(
+            api_key=self.api_key,
+            api_version=API_VERSION,
+            azure_endpoint=self.azure_endpoint,
+            # retries are handled by the RetryPolicy, one pooled connection per in-flight request
+            max_retries=0,
+            http_client=httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=self.max_in_flight, max_keepalive_connections=self.max_in_flight))
+        )
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        request_limiter = RateLimiter(self.requests_per_minute)
+        token_limiter = RateLimiter(self.tokens_per_minute)
+
+        async def run_job(i, instructions, report):
+            try:
+                result = await self._query(client, semaphore, request_limiter, token_limiter,
+                                           instructions, report, max_tokens, temperature)
+            except QueryError as e:
+                result = e
+            if on_result is not None:
+                on_result(i, result)
+            return result
+
+        try:
+            return await asyncio.gather(*[run_job(i, inst, report) for i, (inst, report) in enumerate(jobs)])
+        finally:
+            await client.close()
+
+def query_openai_many(jobs, max_tokens=500, temperature=.4, on_result=None, **engine_kwargs):
+    # synchronous entry point, returns [(completion, cost[, parsed]) or QueryError, ...] in the order of jobs
+    engine = AsyncEngine(**engine_kwargs)
+    return asyncio.run(engine.run(jobs, max_tokens=max_tokens, temperature=temperature, on_result=on_result))
@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import glob
+
+from utils import GPT_MODEL, build_messages, estimate_cost, get_client
+from journal import Journal, read_journal, rebuild_records
+from edit_ops import apply_edit_record
+
+# offline batch-job mode for generate_data: all prompts are written to sharded
+# batch request files, submitted once, and the result files are joined back to the
+# original/n_inst/user_inst records through their custom_id
+
+# batch completions are billed at half the real-time price
+BATCH_DISCOUNT = 0.5
+
+# batch job states that will not change any more. jobs in the last three may still have
+# partial output and error files
+FAILED_STATES = ('failed', 'expired', 'cancelled')
+DONE_STATES = ('completed',) + FAILED_STATES
+
+def custom_id(index):
+    return f'report-{index}'
+
+def write_batch_requests(jobs, out_dir, start_idx, max_tokens=500, temperature=.4, shard_size=50000, edit_mode=False):
+    # jobs are (i, report, n_inst, user_inst) as built by generate_data. writes
+    # batch_requests_{k}.jsonl shards and batch_jobs.jsonl, which keeps the record fields
+    # needed to join the results back
+    n_shards = 0
+    shard = None
+    with open(os.path.join(out_dir, 'batch_jobs.jsonl'), 'w') as jobs_file:
+        for n, (i, report, n_inst, user_inst) in enumerate(jobs):
+            if n % shard_size == 0:
+                if shard is not None:
+                    shard.close()
+                shard = open(os.path.join(out_dir, f'batch_requests_{n_shards}.jsonl'), 'w')
+                n_shards += 1
+
+            shard.write(json.dumps({
+                'custom_id': custom_id(start_idx + i),
+                'method': 'POST',
+                'url': '/chat/completions',
+                'body': {
+                    'model': GPT_MODEL,
+                    'messages': build_messages(user_inst, report['report_text'], edit_mode),
+                    'max_tokens': max_tokens,
+                    'temperature': temperature
+                }
+            }) + '\n')
+            jobs_file.write(json.dumps({
+                'custom_id': custom_id(start_idx + i),
+                'index': start_idx + i,
+                'original': report,
+                'n_inst': n_inst,
+                'user_inst': user_inst
+            }) + '\n')
+    if shard is not None:
+        shard.close()
+    return n_shards
+
+def request_files(out_dir):
+    return sorted(glob.glob(os.path.join(out_dir, 'batch_requests_*.jsonl')),
+                  key=lambda path: int(path.rsplit('_', 1)[1].split('.')[0]))
+
+def submit_file(client, path):
+    with open(path, 'rb') as f:
+        input_file = client.files.create(file=f, purpose='batch')
+    batch = client.batches.create(input_file_id=input_file.id, endpoint='/chat/completions', completion_window='24h')
+    print(f"submitted {path} as {batch.id}")
+    return {'requests': os.path.basename(path), 'batch_id': batch.id}
+
+def load_submissions(out_dir):
+    with open(os.path.join(out_dir, 'batch_submissions.json'), 'r') as f:
+        return json.load(f)
+
+def save_submissions(out_dir, submissions):
+    with open(os.path.join(out_dir, 'batch_submissions.json'), 'w') as f:
+        json.dump(submissions, f, indent=4)
+
+def submit(out_dir):
+    # upload every request shard and start one batch job per shard
+    client = get_client()
+    submissions = [submit_file(client, path) for path in request_files(out_dir)]
+    save_submissions(out_dir, submissions)
+    return submissions
+
+def collect(out_dir):
+    # download the results of finished batch jobs. returns (number still running, number
+    # failed, expired or cancelled); the partial results of those are downloaded too, and
+    # their requests without a result can be sent again with resubmit
+    client = get_client()
+    submissions = load_submissions(out_dir)
+    pending = 0
+    failed = 0
+    for submission in submissions:
+        if submission.get('status') in DONE_STATES:
+            failed += submission['status'] in FAILED_STATES and not submission.get('resubmitted')
+            continue
+        batch = client.batches.retrieve(submission['batch_id'])
+        if batch.status not in DONE_STATES:
+            print(f"{submission['batch_id']} is {batch.status}")
+            pending += 1
+            continue
+
+        results_path = os.path.join(out_dir, submission['requests'].replace('batch_requests_', 'batch_results_'))
+        if batch.output_file_id:
+            with open(results_path, 'wb') as f:
+                f.write(client.files.content(batch.output_file_id).read())
+        if batch.error_file_id:
+            with open(results_path.replace('batch_results_', 'batch_errors_'), 'wb') as f:
+                f.write(client.files.content(batch.error_file_id).read())
+        submission['status'] = batch.status
+        if batch.status in FAILED_STATES:
+            print(f"{submission['batch_id']} {batch.status}, its partial results were downloaded")
+            failed += 1
+    save_submissions(out_dir, submissions)
+    return pending, failed
+
+def answered_ids(out_dir):
+    # custom_ids with a successful result in any downloaded results file
+    answered = set()
+    for path in glob.glob(os.path.join(out_dir, 'batch_results_*.jsonl')):
+        with open(path, 'r') as f:
+            for result in map(json.loads, f):
+                if not result.get('error') and (result.get('response') or {}).get('status_code') == 200:
+                    answered.add(result['custom_id'])
+    return answered
+
+def resubmit(out_dir):
+    # requests of failed, expired or cancelled batch jobs that got no result are written to
+    # a new request shard and submitted as a new batch job
+    submissions = load_submissions(out_dir)
+    answered = answered_ids(out_dir)
+    requests = []
+    for submission in submissions:
+        if submission.get('status') not in FAILED_STATES or submission.get('resubmitted'):
+            continue
+        with open(os.path.join(out_dir, submission['requests']), 'r') as f:
+            requests += [line for line in f if json.loads(line)['custom_id'] not in answered]
+        submission['resubmitted'] = True
+    if not requests:
+        print("no failed requests to resubmit")
+        return None
+
+    path = os.path.join(out_dir, f'batch_requests_{len(request_files(out_dir))}.jsonl')
+    with open(path, 'w') as f:
+        f.writelines(requests)
+    submissions.append(submit_file(get_client(), path))
+    save_submissions(out_dir, submissions)
+    print(f"resubmitted {len(requests)} requests")
+    return submissions[-1]
+
+def ingest(out_dir):
+    # join batch_results_*.jsonl (and batch_errors_*.jsonl) back to the records through the
+    # journal, then rebuild records_{i}.json. results already journaled are skipped, so
+    # ingesting twice, or after a partial collect, is safe
+    with open(os.path.join(out_dir, 'run.json'), 'r') as f:
+        run = json.load(f)
+    with open(os.path.join(out_dir, 'batch_jobs.jsonl'), 'r') as f:
+        jobs = {job['custom_id']: job for job in map(json.loads, f)}
+
+    journal_path = os.path.join(out_dir, 'journal.jsonl')
+    done = read_journal(journal_path)
+    journal = Journal(journal_path)
+    failures = []
+    total_cost = 0
+
+    for path in sorted(glob.glob(os.path.join(out_dir, 'batch_results_*.jsonl')) +
+                       glob.glob(os.path.join(out_dir, 'batch_errors_*.jsonl'))):
+        with open(path, 'r') as f:
+            for line in f:
+                result = json.loads(line)
+                job = jobs[result['custom_id']]
+                if job['index'] in done:
+                    continue
+
+                response = result.get('response') or {}
+                if result.get('error') or response.get('status_code') != 200:
+                    failures.append({'index': job['index'], 'report_id': job['original'].get('report_id'),
+                                     'error': result.get('error') or response.get('body'),
+                                     'status_code': response.get('status_code')})
+                    continue
+
+                body = response['body']
+                total_cost += BATCH_DISCOUNT * estimate_cost(body['usage']['prompt_tokens'], body['usage']['completion_tokens'])
+                record = {
+                    'original': job['original'],
+                    'n_inst': job['n_inst'],
+                    'user_inst': job['user_inst'],
+                    'response': body['choices'][0]['message']['content']
+                }
+                if run.get('edit_mode'):
+                    apply_edit_record(record)
+                journal.append(job['index'], record)
+                done[job['index']] = record
+    journal.close()
+    # a request that failed in one batch job may have succeeded after resubmit
+    failures = list({failure['index']: failure for failure in failures if failure['index'] not in done}.values())
+
+    n_written = rebuild_records(out_dir, run['start_idx'], run['n_reports'], run['save_every'])
+    missing = len([job for job in jobs.values() if job['index'] not in done]) - len(failures)
+    print(f"ingested batch results: {n_written} records, {len(failures)} failed, {missing} without a result yet, "
+          f"cost {total_cost}")
+    if failures:
+        with open(os.path.join(out_dir, 'failures.json'), 'w') as f:
+            json.dump(failures, f, indent=4)
+    return n_written
+
+if __name__ == '__main__':
+    # python batch_jobs.py {submit,collect,resubmit,ingest} <output dir written by generate.py --batch>
+    command, out_dir = sys.argv[1], sys.argv[2]
+    if command == 'submit':
+        submit(out_dir)
+    elif command == 'collect':
+        pending, failed = collect(out_dir)
+        print(f"{pending} batch jobs still running, {failed} failed, expired or cancelled")
+    elif command == 'resubmit':
+        resubmit(out_dir)
+    elif command == 'ingest':
+        ingest(out_dir)
+    else:
+        raise ValueError(f"unknown command {command}")
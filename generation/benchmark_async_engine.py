@@ -0,0 +1,60 @@
+import sys
+import time
+import argparse
+
+import utils
+from async_engine import query_openai_many
+from mock_openai_server import start_server
+
+# runs synthetic generation jobs against the local mock endpoint, sequentially
+# through query_openai and concurrently through the async engine
+
+def make_jobs(n):
+    jobs = []
+    for i in range(n):
+        report = f"FINDINGS:\n1. Report number {i}.\n\nIMPRESSION:\n2. No acute process.\n"
+        jobs.append(("Create the following instruction(s): an instruction to add an observation in the entire report", report))
+    return jobs
+
+def in_order(jobs, responses):
+    return all(not isinstance(response, Exception) and response[0].rstrip().endswith(report.strip())
+               for (_, report), response in zip(jobs, responses))
+
+def main(args):
+    server, endpoint = start_server(latency=args.latency, rate_limit_prob=args.rate_limit_prob, retry_after=args.retry_after)
+    utils.AZURE_ENDPOINT = endpoint
+    utils.API_KEY = 'mock'
+    jobs = make_jobs(args.n)
+
+    if args.sequential:
+        start = time.perf_counter()
+        responses = [utils.query_openai(inst, report) for inst, report in jobs[:args.sequential]]
+        elapsed = time.perf_counter() - start
+        print(f"sequential: {len(responses)} requests in {elapsed:.1f}s ({len(responses)/elapsed:.1f} req/s)")
+
+    server.n_requests = server.n_rate_limited = 0
+    start = time.perf_counter()
+    responses = query_openai_many(
+        jobs, max_in_flight=args.concurrency, requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+        azure_endpoint=endpoint, api_key='mock')
+    elapsed = time.perf_counter() - start
+    print(f"async x{args.concurrency}: {len(responses)} requests in {elapsed:.1f}s ({len(responses)/elapsed:.1f} req/s), "
+          f"{server.n_rate_limited} of {server.n_requests} answered 429")
+
+    ordered = in_order(jobs, responses)
+    print(f"results in report order: {ordered}")
+    server.shutdown()
+    return ordered
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n', type=int, default=500, help="number of requests")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--rpm', type=int, default=0, help="requests-per-minute budget")
+    parser.add_argument('--tpm', type=int, default=0, help="tokens-per-minute budget")
+    parser.add_argument('--latency', type=float, default=0.5, help="mock seconds per completion")
+    parser.add_argument('--rate_limit_prob', type=float, default=0.05, help="mock probability of a 429")
+    parser.add_argument('--retry_after', type=int, default=1)
+    parser.add_argument('--sequential', type=int, default=20, help="requests to time sequentially, 0 skips")
+    args = parser.parse_args()
+    sys.exit(0 if main(args) else 1)
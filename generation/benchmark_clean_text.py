@@ -0,0 +1,144 @@
+import os
+import re
+import sys
+import time
+import argparse
+import pysbd
+
+from preprocess import clean_text
+
+# reference implementation, kept verbatim from before the single-pass parser
+def clean_text_reference(content):
+
+    content = content.replace('\n', ' ')
+    content = re.sub(r'\s{2,}', ' ', content)
+
+    # split the content to extract the part after "FINDINGS:"
+    findings_split = re.split(r'(?i)FINDING[S]?:', content)
+    if len(findings_split) > 1:
+        findings_part = findings_split[1]
+        findings_text = re.split(r'(?i)IMPRESSION[S]?:', findings_part)[0].strip()
+    else:
+        findings_text = ""
+
+    # split the content to extract the part after "IMPRESSION:"
+    impression_split = re.split(r'(?i)IMPRESSION[S]?:', content)
+    impression_text = impression_split[1].strip() if len(impression_split) > 1 else ''
+
+    # split text into sentences
+    seg = pysbd.Segmenter(language="en", clean=False)
+    findings_sentences = seg.segment(findings_text)
+    impression_sentences = seg.segment(impression_text)
+
+    findings_sentences = [sentence for sentence in findings_sentences if bool(re.search(r'\w', sentence))]
+    impression_sentences = [sentence for sentence in impression_sentences if bool(re.search(r'\w', sentence))]
+
+    def remove_leading_numbers(sentence):
+        return re.sub(r'^\d+[\.\)]\s*', '', sentence)
+
+    findings_sentences = [remove_leading_numbers(sentence) for sentence in findings_sentences]
+    impression_sentences = [remove_leading_numbers(sentence) for sentence in impression_sentences]
+
+    # Prepend sentence numbers
+    numbered_sentences = []
+    sentence_number = 1
+
+    if findings_text:
+        numbered_sentences.append("FINDINGS:\n")
+        for sentence in findings_sentences:
+            if sentence:
+                numbered_sentences.append(f"{sentence_number}. {sentence}\n")
+                sentence_number += 1
+
+    if impression_text:
+        if findings_text:
+            numbered_sentences.append("\n")
+        numbered_sentences.append("IMPRESSION:\n")
+        for sentence in impression_sentences:
+            if sentence:
+                numbered_sentences.append(f"{sentence_number}. {sentence}\n")
+                sentence_number += 1
+
+    # combined numbered sentences with newline characters
+    numbered_text = ''.join(numbered_sentences)
+
+    return numbered_text, len(findings_sentences) + len(impression_sentences)
+
+# small built-in corpus covering the header variants handled by the parser
+SAMPLE_REPORTS = [
+    """                                 FINAL REPORT
+ EXAMINATION:  CHEST (PA AND LAT)
+
+ FINDINGS:
+
+ PA and lateral views of the chest provided.  There is no focal consolidation,
+ effusion, or pneumothorax.  The cardiomediastinal silhouette is normal.  Imaged
+ osseous structures are intact.  No free air below the right hemidiaphragm is
+ seen.
+
+ IMPRESSION:
+
+ No acute intrathoracic process.
+""",
+    """ FINAL REPORT
+ INDICATION:  ___-year-old with chest pain.
+
+ FINDING: 1. Lungs are clear. 2) Heart size is top normal.
+ IMPRESSIONS: 1. No acute cardiopulmonary process.  2. No pleural effusion.
+""",
+    """ IMPRESSION: Endotracheal tube terminates 4.5 cm above the carina.
+ FINDINGS: Nasogastric tube has been advanced.  Mild pulmonary edema.
+ IMPRESSION: Unchanged.
+""",
+    """ COMPARISON:  None.  Findings: ... . Impression: ...
+""",
+    """ No headers in this report at all.
+""",
+]
+
+def load_corpus(corpus_dir):
+    reports = []
+    for root, _, files in sorted(os.walk(corpus_dir)):
+        for report_file in sorted(files):
+            if report_file.endswith('.txt'):
+                with open(os.path.join(root, report_file), 'r') as file:
+                    reports.append(file.read())
+    return reports
+
+def time_fn(fn, reports, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for report in reports:
+            fn(report)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main(args):
+    reports = load_corpus(args.corpus_dir) if args.corpus_dir else SAMPLE_REPORTS * 200
+    if args.limit:
+        reports = reports[:args.limit]
+    print(f"# reports {len(reports)}")
+
+    # outputs must stay byte-for-byte identical
+    mismatches = 0
+    for report in reports:
+        if clean_text(report) != clean_text_reference(report):
+            mismatches += 1
+    print(f"# mismatching outputs {mismatches}")
+
+    reference_time = time_fn(clean_text_reference, reports, args.repeat)
+    new_time = time_fn(clean_text, reports, args.repeat)
+    print(f"reference clean_text: {reference_time:.3f}s ({len(reports)/reference_time:.1f} reports/s)")
+    print(f"single-pass clean_text: {new_time:.3f}s ({len(reports)/new_time:.1f} reports/s)")
+    print(f"speedup: {reference_time/new_time:.2f}x")
+
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus_dir', type=str, default='', help="directory of raw MIMIC-CXR .txt reports, searched recursively")
+    parser.add_argument('--limit', type=int, default=0, help="only use the first N reports")
+    parser.add_argument('--repeat', type=int, default=3, help="timing repeats, best is reported")
+    args = parser.parse_args()
+    sys.exit(1 if main(args) else 0)
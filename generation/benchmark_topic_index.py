@@ -0,0 +1,66 @@
+import sys
+import time
+import random
+import argparse
+
+from utils import Topic, topic_variants
+from data_io import load_reports
+from Instructions import Instructions, TopicIndex, NO_TOPIC_INST
+
+# compares per-topic substring scans (what search_report does, one topic at a time)
+# with the single-pass TopicIndex over the preprocessed reports, and measures
+# topic-aware instruction sampling
+
+def naive_find_sections(report):
+    findings, _, impression = report.partition('IMPRESSION:')
+    sections = {'report': report.lower(), 'findings': findings.lower() if 'FINDINGS:' in findings else '',
+                'impression': impression.lower()}
+    found = {name: set() for name in sections}
+    for topic in Topic:
+        for pattern in [topic.value] + topic_variants.get(topic, []):
+            for name, text in sections.items():
+                if pattern.lower() in text:
+                    found[name].add(topic)
+    return found
+
+def main(args):
+    reports = [r['report_text'] for r in load_reports(args.data_path)]
+    if args.limit:
+        reports = reports[:args.limit]
+    print(f"# reports {len(reports)}")
+
+    start = time.perf_counter()
+    naive = [naive_find_sections(r) for r in reports]
+    naive_time = time.perf_counter() - start
+
+    index = TopicIndex()
+    start = time.perf_counter()
+    indexed = [index.find_sections(r) for r in reports]
+    index_time = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b in zip(naive, indexed) if a != b)
+    print(f"per-topic scan: {naive_time:.2f}s, topic index: {index_time:.2f}s ({naive_time/index_time:.1f}x), "
+          f"{mismatches} mismatching reports")
+    with_topic = sum(1 for found in indexed if found['report'])
+    print(f"reports mentioning at least one topic: {with_topic} ({with_topic/len(reports):.1%})")
+
+    random.seed(0)
+    inst_maker = Instructions(topic_aware=True)
+    start = time.perf_counter()
+    n_grounded = n_total = 0
+    for report in reports:
+        insts = inst_maker.get_insts(report, n=3) or ''
+        n_total += insts.count('an instruction to')
+        n_grounded += sum(insts.count(f"to {t.value} ") for t in NO_TOPIC_INST)
+    sample_time = time.perf_counter() - start
+    print(f"topic-aware get_insts: {sample_time:.2f}s for {len(reports)} reports, "
+          f"{n_grounded} of {n_total} instructions are grounded RM/CHG instructions")
+
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, default='../data/test.jsonl', help="preprocessed reports")
+    parser.add_argument('--limit', type=int, default=0, help="only use the first N reports")
+    args = parser.parse_args()
+    sys.exit(1 if main(args) else 0)
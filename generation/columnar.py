@@ -0,0 +1,127 @@
+import os
+import sys
+import bisect
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+from data_io import load_reports, load_dataset
+
+# one schema for the whole pipeline: preprocessed reports, generated instructions,
+# ground-truth edits and model predictions. columns a stage does not produce are null
+SCHEMA = pa.schema([
+    pa.field('id', pa.string()),
+    pa.field('patient_id', pa.string()),
+    pa.field('report_id', pa.string()),
+    pa.field('report_text', pa.string()),
+    pa.field('n_inst', pa.int32()),
+    pa.field('instructions', pa.string()),
+    pa.field('modified_text', pa.string()),
+    pa.field('predicted', pa.string()),
+])
+
+def write_dataset(records, path, batch_size=10000):
+    # records can be any iterable of dicts, they are written batch by batch.
+    # .arrow is an uncompressed Arrow IPC file that can be memory mapped zero-copy,
+    # .parquet is smaller on disk but has to be decoded on read
+    if path.endswith('.parquet'):
+        writer = pq.ParquetWriter(path, SCHEMA)
+        write = writer.write_batch
+    else:
+        sink = pa.OSFile(path, 'wb')
+        writer = ipc.new_file(sink, SCHEMA)
+        write = writer.write_batch
+
+    n_rows = 0
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            write(pa.RecordBatch.from_pylist(batch, schema=SCHEMA))
+            n_rows += len(batch)
+            batch = []
+    if batch:
+        write(pa.RecordBatch.from_pylist(batch, schema=SCHEMA))
+        n_rows += len(batch)
+
+    writer.close()
+    if not path.endswith('.parquet'):
+        sink.close()
+    return n_rows
+
+class ColumnarDataset:
+    # memory-mapped, list-like view over a dataset written by write_dataset.
+    # indexing returns row dicts, so it can be used wherever the JSON/CSV records were
+
+    def __init__(self, path):
+        self.path = path
+        if path.endswith('.parquet'):
+            self._parquet = pq.ParquetFile(path, memory_map=True)
+            self._table = None
+            self.num_rows = self._parquet.metadata.num_rows
+            self.column_names = self._parquet.schema_arrow.names
+            # first row of every row group, to read row ranges without decoding the rest
+            self._group_starts = [0]
+            for i in range(self._parquet.num_row_groups):
+                self._group_starts.append(self._group_starts[-1] + self._parquet.metadata.row_group(i).num_rows)
+            # the last row group decoded for indexing, consecutive data[k] reuse it
+            self._group = None
+        else:
+            self._parquet = None
+            self._table = ipc.open_file(pa.memory_map(path, 'r')).read_all()
+            self.num_rows = self._table.num_rows
+            self.column_names = self._table.column_names
+
+    def __len__(self):
+        return self.num_rows
+
+    def column(self, name):
+        if self._table is not None:
+            return self._table.column(name)
+        return self._parquet.read(columns=[name]).column(name)
+
+    def table(self, start, stop, columns=None):
+        start, stop = max(start, 0), min(stop, self.num_rows)
+        if stop <= start:
+            return SCHEMA.empty_table().select(columns or self.column_names)
+
+        if self._table is not None:
+            table = self._table.slice(start, stop - start)
+            return table.select(columns) if columns else table
+
+        groups = [i for i in range(self._parquet.num_row_groups)
+                  if self._group_starts[i] < stop and self._group_starts[i + 1] > start]
+        table = self._parquet.read_row_groups(groups, columns=columns)
+        offset = self._group_starts[groups[0]]
+        return table.slice(start - offset, stop - start)
+
+    def rows(self, start, stop, columns=None):
+        return self.table(start, stop, columns).to_pylist()
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self.num_rows)
+            return self.rows(start, stop)[::step]
+        if idx < 0:
+            idx += self.num_rows
+        if not 0 <= idx < self.num_rows:
+            raise IndexError(idx)
+        if self._parquet is None:
+            return self.rows(idx, idx + 1)[0]
+        group = bisect.bisect_right(self._group_starts, idx) - 1
+        if self._group is None or self._group[0] != group:
+            self._group = (group, self._parquet.read_row_group(group))
+        return self._group[1].slice(idx - self._group_starts[group], 1).to_pylist()[0]
+
+    def __iter__(self):
+        for start in range(0, self.num_rows, 10000):
+            yield from self.rows(start, start + 10000)
+
+def convert(in_path, out_path):
+    # convert a RadRevise CSV, or a preprocessed JSON/JSONL report file, to a columnar dataset
+    records = load_dataset(in_path) if in_path.endswith('.csv') else load_reports(in_path)
+    n_rows = write_dataset(records, out_path)
+    print(f"wrote {n_rows} rows to {out_path} ({os.path.getsize(out_path)/1e6:.1f} MB)")
+
+if __name__ == '__main__':
+    convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,124 @@
+import io
+import gzip
+import json
+from itertools import islice
+
+def open_text(path, mode='r'):
+    # transparently (de)compress files ending in .gz
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+class JsonlWriter:
+    # writes one JSON record per line as soon as it is produced
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.file = open_text(path, 'a' if append else 'w')
+        self.count = 0
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def iter_jsonl(path, start=0, end=None):
+    # lazily yield records[start:end], only lines in the range are parsed
+    with open_text(path) as f:
+        for line in islice(f, start, end):
+            if line.strip():
+                yield json.loads(line)
+
+class JsonlReports:
+    # lazy, list-like view over a JSONL file. a byte offset per line is collected on first
+    # access, so len() and reports[start:end] only parse the requested records.
+    # compressed files can not be seeked cheaply and are read sequentially instead
+
+    def __init__(self, path):
+        self.path = path
+        self._offsets = None
+
+    def _index(self):
+        if self._offsets is None:
+            offsets = []
+            if self.path.endswith('.gz'):
+                with open_text(self.path) as f:
+                    offsets = [i for i, line in enumerate(f) if line.strip()]
+            else:
+                with open(self.path, 'rb') as f:
+                    pos = 0
+                    for line in f:
+                        if line.strip():
+                            offsets.append(pos)
+                        pos += len(line)
+            self._offsets = offsets
+        return self._offsets
+
+    def __len__(self):
+        return len(self._index())
+
+    def _read(self, start, stop):
+        offsets = self._index()[start:stop]
+        if not offsets:
+            return []
+        if self.path.endswith('.gz'):
+            # offsets are line numbers for compressed files
+            return list(iter_jsonl(self.path, offsets[0], offsets[-1] + 1))
+
+        records = []
+        with open(self.path, 'rb') as f:
+            f.seek(offsets[0])
+            for line in io.TextIOWrapper(f, encoding='utf-8'):
+                if len(records) == len(offsets):
+                    break
+                if line.strip():
+                    records.append(json.loads(line))
+        return records
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            return self._read(start, stop)[::step]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return self._read(idx, idx + 1)[0]
+
+    def __iter__(self):
+        return iter_jsonl(self.path)
+
+# Arrow IPC / Parquet datasets, see columnar.py
+COLUMNAR_SUFFIXES = ('.arrow', '.parquet')
+
+def load_reports(path):
+    # JSONL (optionally gzipped) is read lazily, columnar files are memory mapped,
+    # legacy JSON arrays are loaded fully
+    if path.endswith(COLUMNAR_SUFFIXES):
+        from columnar import ColumnarDataset
+        return ColumnarDataset(path)
+    if path.endswith('.jsonl') or path.endswith('.jsonl.gz'):
+        return JsonlReports(path)
+    with open_text(path) as json_file:
+        return json.load(json_file)
+
+def load_dataset(path):
+    # RadRevise records for evaluation: columnar files are memory mapped, CSV files
+    # (e.g. RadRevise_v0.csv) are read into a list of row dicts
+    if path.endswith(COLUMNAR_SUFFIXES):
+        from columnar import ColumnarDataset
+        return ColumnarDataset(path)
+    import pandas as pd
+    data = pd.read_csv(path)
+    return data.astype(object).where(data.notna(), None).to_dict('records')
@@ -0,0 +1,173 @@
+import re
+
+from response_parser import SECTION_HEADER, NUMBERED_LINE, INSTRUCTIONS_HEADER, INSTRUCTION_SPLIT, format_report
+
+# edit-script output mode: instead of regenerating the whole modified report, the model
+# replies with line-level operations on the numbered original report, one per line
+#   REPLACE 3: <new sentence>
+#   INSERT AFTER 5: <new sentence>      (INSERT AFTER 0 puts it before the first line)
+#   APPEND FINDINGS: <new sentence>     (or APPEND IMPRESSION:, creates the section if needed)
+#   DELETE 7
+#   NO CHANGES
+# line numbers always refer to the original report. apply_edits rebuilds and renumbers it
+
+EDITS_HEADER = re.compile(r'(?i)\bedits\s*:')
+REPLACE_OP = re.compile(r'(?i)^replace\s+(?:line\s+)?(\d+)\s*:\s*(.+)$')
+INSERT_OP = re.compile(r'(?i)^insert\s+after\s+(?:line\s+)?(\d+)\s*:\s*(.+)$')
+APPEND_OP = re.compile(r'(?i)^append\s+(?:to\s+)?(findings|impression)\s*:\s*(.+)$')
+DELETE_OP = re.compile(r'(?i)^delete\s+(?:line\s+)?(\d+)\s*\.?$')
+NO_CHANGES = re.compile(r'(?i)^no\s+changes?\.?$')
+LIST_MARKER = re.compile(r'^(?:[-*•]|\d+[\.\)])\s+(?=[A-Za-z])')
+
+SECTION_ORDER = ['FINDINGS', 'IMPRESSION']
+
+class EditError(ValueError):
+    pass
+
+def parse_report(report):
+    # clean_text layout -> [(section, [sentences])]
+    sections = []
+    for line in report.split('\n'):
+        line = line.strip()
+        header = SECTION_HEADER.match(line)
+        if header:
+            sections.append(('FINDINGS' if header.group(1).upper().startswith('F') else 'IMPRESSION', []))
+            line = header.group(2).strip()
+        numbered = NUMBERED_LINE.match(line)
+        if numbered and sections:
+            sections[-1][1].append(numbered.group(2).strip())
+    return sections
+
+def parse_edits(text):
+    # returns ([(op, target, sentence)], unparsed lines)
+    ops = []
+    unparsed = []
+    for line in text.split('\n'):
+        line = LIST_MARKER.sub('', line.strip())
+        if not line or NO_CHANGES.match(line):
+            continue
+        for op, pattern in [('replace', REPLACE_OP), ('insert', INSERT_OP), ('append', APPEND_OP), ('delete', DELETE_OP)]:
+            match = pattern.match(line)
+            if match:
+                if op == 'append':
+                    ops.append((op, match.group(1).upper(), match.group(2).strip()))
+                elif op == 'delete':
+                    ops.append((op, int(match.group(1)), None))
+                else:
+                    ops.append((op, int(match.group(1)), match.group(2).strip()))
+                break
+        else:
+            if ops:
+                # anything after the edit script is commentary
+                break
+            unparsed.append(line)
+    return ops, unparsed
+
+def apply_edits(report, ops):
+    # every original line is a slot holding its (possibly replaced or deleted) sentence and
+    # the sentences inserted after it; slot 0 is before the first line
+    sections = parse_report(report)
+    if not sections:
+        sections = [('FINDINGS', [])]
+    slots = {}
+    layout = []
+    number = 1
+    for k, (section, sentences) in enumerate(sections):
+        section_slots = []
+        if k == 0:
+            slots[0] = {'line': None, 'after': []}
+            section_slots.append(slots[0])
+        for sentence in sentences:
+            slots[number] = {'line': sentence, 'after': []}
+            section_slots.append(slots[number])
+            number += 1
+        layout.append([section, section_slots, []])
+
+    for op, target, sentence in ops:
+        if op == 'append':
+            names = [section for section, _, _ in layout]
+            if target not in names:
+                # new section, kept in FINDINGS, IMPRESSION order
+                position = sum(1 for name in names if SECTION_ORDER.index(name) < SECTION_ORDER.index(target))
+                layout.insert(position, [target, [], []])
+                names.insert(position, target)
+            layout[names.index(target)][2].append(sentence)
+            continue
+        if target not in slots or (target == 0 and op != 'insert'):
+            raise EditError(f"{op} refers to line {target}, the report has lines 1-{number - 1}")
+        if op == 'replace':
+            slots[target]['line'] = sentence
+        elif op == 'delete':
+            slots[target]['line'] = None
+        else:
+            slots[target]['after'].append(sentence)
+
+    edited = []
+    for section, section_slots, appended in layout:
+        sentences = []
+        for slot in section_slots:
+            if slot['line'] is not None:
+                sentences.append(slot['line'])
+            sentences += slot['after']
+        edited.append((section, sentences + appended))
+    return format_report(edited)
+
+def split_edit_response(completion):
+    # "Instructions: ... Edits: ..." -> (instruction text, edit script)
+    match = EDITS_HEADER.search(completion)
+    if not match:
+        return None, completion
+    instructions = completion[:match.start()]
+    header = INSTRUCTIONS_HEADER.search(instructions)
+    return (instructions[header.end():] if header else instructions), completion[match.end():]
+
+def parse_edit_response(completion, report):
+    # structured record for a generation reply in edit mode, like ResponseParser.result()
+    instruction_text, script = split_edit_response(completion)
+    ops, unparsed = parse_edits(script)
+    instructions = [part.strip() for part in INSTRUCTION_SPLIT.split(instruction_text or '') if part.strip()]
+    error = None
+    modified_report = None
+    if instruction_text is None:
+        error = 'no "Edits:" in the response'
+    elif unparsed:
+        error = f'unparsed edit line: {unparsed[0][:80]!r}'
+    else:
+        try:
+            modified_report = apply_edits(report, ops)
+        except EditError as e:
+            error = str(e)
+    return {
+        'valid': error is None,
+        'error': error,
+        'instructions': instructions,
+        'edits': ops,
+        'modified_report': modified_report
+    }
+
+def format_response(parsed):
+    # back to the "Instructions: ... Modified Report: ..." layout of a full-report reply
+    instructions = ' '.join(f"Instruction {i+1}: {inst}" for i, inst in enumerate(parsed['instructions']))
+    return f"Instructions: {instructions} \n Modified Report: \n{parsed['modified_report']}"
+
+def apply_edit_record(record):
+    # in place for a generated record: the edit reply is kept as edit_response and, when
+    # the edits apply, response becomes the reconstructed full-report reply
+    parsed = parse_edit_response(record['response'], record['original']['report_text'])
+    record['edit_response'] = record['response']
+    record['parsed'] = parsed
+    if parsed['valid']:
+        record['response'] = format_response(parsed)
+    return parsed
+
+def apply_edit_script(report, completion):
+    # for a model output in edit mode, returns (edited report, error or None). an output
+    # whose edits do not apply leaves the report unchanged
+    _, script = split_edit_response(completion)
+    ops, unparsed = parse_edits(script)
+    if unparsed:
+        return report, f'unparsed edit line: {unparsed[0][:80]!r}'
+    try:
+        return apply_edits(report, ops), None
+    except EditError as e:
+        return report, str(e)
@@ -1,5 +1,6 @@
 import os
 import json
+import argparse
 import random
 import pandas as pd
 from tqdm import tqdm
@@ -7,10 +8,35 @@ from datetime import datetime
 
 from Instructions import Instructions
 from utils import *
-
-def generate_data(start_idx=300, end_idx=400, save_every=100, seed=0):
-
-    random.seed(seed)
+from data_io import load_reports
+from async_engine import query_openai_many
+from response_cache import ResponseCache
+from journal import Journal, read_journal, write_batch, rebuild_records
+from batch_jobs import BATCH_DISCOUNT, write_batch_requests
+from prompt_stats import PromptStats, preflight
+from edit_ops import apply_edit_record, format_response
+
+def try_query_openai(*args, stream=False, edit_mode=False, **kwargs):
+    # failed requests are returned as QueryError and recorded, instead of stopping the run
+    try:
+        if stream:
+            return query_openai_stream(*args, **kwargs)
+        return query_openai(*args, edit_mode=edit_mode, **kwargs)
+    except QueryError as e:
+        return e
+
+def report_rng(seed, report):
+    # independent random stream per report, derived from (seed, report id), so a report
+    # gets the same instructions whatever order, shard or process it is generated in
+    return random.Random(f"{seed}/{report.get('patient_id')}/{report.get('report_id')}")
+
+def generate_data(start_idx=300, end_idx=400, save_every=100, seed=0, data_path='../data/test.jsonl',
+                  concurrency=1, requests_per_minute=0, tokens_per_minute=0,
+                  cache_path='../output/response_cache.sqlite', bypass_cache=False, resume=None, batch=False, topic_aware=False,
+                  shard=0, num_shards=1, stream=False, max_total_tokens=0, max_cost=0, edit_mode=False):
+
+    if stream and edit_mode:
+        raise ValueError("streaming parses full-report replies, it cannot be combined with edit_mode")
 
     # set weights for types of instructions
     inst_type_weights = {
@@ -40,45 +66,184 @@ def generate_data(start_idx=300, end_idx=400, save_every=100, seed=0):
         Location.LINE_LAST:0
     }
 
-    inst_maker = Instructions(inst_type_weights=inst_type_weights, location_weights=location_weights)    
+    inst_maker = Instructions(inst_type_weights=inst_type_weights, location_weights=location_weights, topic_aware=topic_aware)    
 
-    # MIMIC-CXR test set reports, after preprocessing
-    with open('../data/test.json', 'r') as json_file:
-        reports = json.load(json_file)
+    # MIMIC-CXR test set reports, after preprocessing. jsonl files are read lazily,
+    # so only reports[start_idx:end_idx] is parsed
+    reports = load_reports(data_path)
 
     print(f"len is {end_idx-start_idx}")
 
-    data = []
     total_cost = 0
 
-    now = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
-    os.makedirs(f'../output/output_{now}', exist_ok=True)
-
     reports = reports[start_idx:end_idx]
-    for i, report in tqdm(enumerate(reports), total = len(reports)):
+    run = {'start_idx': start_idx, 'n_reports': len(reports), 'save_every': save_every, 'seed': seed, 'data_path': data_path,
+           'topic_aware': topic_aware, 'shard': shard, 'num_shards': num_shards, 'edit_mode': edit_mode}
+
+    # every completed record goes to an fsynced journal first. resume=<output dir> continues
+    # an interrupted run there, skipping the reports it already journaled
+    if resume:
+        out_dir = resume
+        with open(os.path.join(out_dir, 'run.json'), 'r') as f:
+            saved = json.load(f)
+        differ = sorted(key for key in saved.keys() | run.keys() if saved.get(key) != run.get(key))
+        if differ:
+            raise ValueError(f"resume needs the arguments of the run in {out_dir}, these differ: "
+                             + ', '.join(f"{key} (was {saved.get(key)!r}, now {run.get(key)!r})" for key in differ))
+    else:
+        now = datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+        out_dir = f'../output/output_{now}' + (f'_shard{shard}' if num_shards > 1 else '')
+        os.makedirs(out_dir, exist_ok=True)
+        with open(os.path.join(out_dir, 'run.json'), 'w') as f:
+            json.dump(run, f, indent=4)
+
+    journal_path = os.path.join(out_dir, 'journal.jsonl')
+    records = read_journal(journal_path)
+    journal = Journal(journal_path)
+    if records:
+        print(f"resuming: {len(records)} reports already journaled")
+
+    # each shard takes every num_shards-th report. instructions only depend on the
+    # report's own random stream, so any shard count produces the same records
+    jobs = []
+    for i, report in enumerate(reports):
+        if i % num_shards != shard:
+            continue
 
-        n_inst = random.choices([1, 2, 3, 4, 5], weights=[4, 2, 2, 1, 1])[0]
-        user_inst = inst_maker.get_insts(report['report_text'], n=n_inst)
+        rng = report_rng(seed, report)
+        n_inst = rng.choices([1, 2, 3, 4, 5], weights=[4, 2, 2, 1, 1])[0]
+        user_inst = inst_maker.get_insts(report['report_text'], n=n_inst, rng=rng)
 
         if user_inst is None:
             continue
 
-        response, cost = query_openai(user_inst, report['report_text'])
-
-        data.append({
+        if start_idx + i not in records:
+            jobs.append((i, report, n_inst, user_inst))
+
+    # refuse to start a run whose worst-case size exceeds the budget
+    queries = [(user_inst, report['report_text']) for _, report, _, user_inst in jobs]
+    preflight(queries, token_budget=max_total_tokens, cost_budget=max_cost, discount=BATCH_DISCOUNT if batch else 1.0,
+              edit_mode=edit_mode)
+
+    # offline batch-job mode: write the prompts as sharded batch request files and stop.
+    # results are joined back later with `python batch_jobs.py ingest <out_dir>`
+    if batch:
+        journal.close()
+        n_shards = write_batch_requests(jobs, out_dir, start_idx, edit_mode=edit_mode)
+        print(f"wrote {len(jobs)} requests in {n_shards} batch files to {out_dir}")
+        return
+
+    # reruns over the same reports and seed are served from the response cache
+    cache = ResponseCache(cache_path, bypass=bypass_cache) if cache_path else None
+
+    failures = []
+    prompt_stats = PromptStats(edit_mode)
+    parse_stats = {'invalid': 0, 'aborted': 0, 'ttft': [], 'latency': []}
+    def on_result(k, result):
+        nonlocal total_cost
+        i, report, n_inst, user_inst = jobs[k]
+        if isinstance(result, QueryError):
+            failures.append({'index': start_idx + i, 'report_id': report.get('report_id'), **result.to_dict()})
+            return
+        response, cost = result[:2]
+        record = {
             'original': report,
             'n_inst': n_inst,
             'user_inst': user_inst, 
             'response': response
-        })
-
+        }
+        if edit_mode:
+            # the edit script is applied to the original report, response holds the full-report reply
+            apply_edit_record(record)
+            parse_stats['invalid'] += not record['parsed']['valid']
+        if stream:
+            # structured response: instruction list, renumbered modified report and timings
+            parsed = result[2]
+            record['parsed'] = parsed
+            parse_stats['invalid'] += not parsed['valid']
+            parse_stats['aborted'] += parsed['aborted']
+            if parsed['latency'] is not None:
+                parse_stats['latency'].append(parsed['latency'])
+            if parsed['ttft'] is not None:
+                parse_stats['ttft'].append(parsed['ttft'])
+            if parsed['aborted']:
+                # the text of a stream closed early is cut short. a complete report is kept as
+                # the reconstructed reply, a malformed one is not journaled, so resume retries it
+                if not parsed['valid']:
+                    total_cost += cost
+                    failures.append({'index': start_idx + i, 'report_id': report.get('report_id'),
+                                     'error': f"malformed streamed response: {parsed['error']}", 'response': response})
+                    return
+                record['response'] = format_response(parsed)
+        journal.append(start_idx + i, record)
+        records[start_idx + i] = record
         total_cost += cost
-        if ((i+1)%save_every==0):
-            print(f"Total cost by {i} report is {total_cost}")
-            with open(f'../output/output_{now}/records_{i}.json', 'w') as f:
-                json.dump(data, f, indent=4)
-
-            data = []
+        prompt_stats.add(user_inst, report['report_text'], record.get('edit_response', response))
+
+    if concurrency > 1:
+        # async engine keeps `concurrency` requests in flight and journals each result as it arrives
+        pbar = tqdm(total=len(queries), desc="querying")
+        def on_async_result(k, result):
+            on_result(k, result)
+            pbar.update(1)
+        query_openai_many(
+            queries, on_result=on_async_result, max_in_flight=concurrency, 
+            requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute, cache=cache, stream=stream,
+            edit_mode=edit_mode)
+        pbar.close()
+    else:
+        for k, (user_inst, report_text) in tqdm(enumerate(queries), total=len(queries)):
+            on_result(k, try_query_openai(user_inst, report_text, cache=cache, stream=stream, edit_mode=edit_mode))
+
+            # write a batch file as soon as its last report is done
+            i = jobs[k][0]
+            if (i+1)%save_every==0:
+                print(f"Total cost by {i} report is {total_cost}")
+                write_batch(records, out_dir, i // save_every, save_every, len(reports), start_idx)
+
+    journal.close()
+
+    # (re)build all batch files from the journal, including the trailing partial batch
+    n_written = rebuild_records(out_dir, start_idx, len(reports), save_every)
+    print(f"Total cost is {total_cost}, {n_written} records in {out_dir}")
+    print(prompt_stats.report())
+
+    if edit_mode:
+        print(f"{parse_stats['invalid']} edit scripts did not apply to their report, their raw reply is kept as response")
+    if stream and parse_stats['latency']:
+        ttft, latency = parse_stats['ttft'], parse_stats['latency']
+        print(f"streamed {len(latency)} completions: {parse_stats['invalid']} malformed, {parse_stats['aborted']} stopped early, "
+              f"mean time to first token {sum(ttft)/max(len(ttft), 1):.2f}s, mean latency {sum(latency)/len(latency):.2f}s")
+
+    if failures:
+        print(f"{len(failures)} reports failed, see failures.json")
+        with open(os.path.join(out_dir, 'failures.json'), 'w') as f:
+            json.dump(failures, f, indent=4)
+
+    if cache is not None:
+        print(cache.report())
+        cache.close()
 
 if __name__=='__main__':
-    generate_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start_idx', type=int, default=300)
+    parser.add_argument('--end_idx', type=int, default=400)
+    parser.add_argument('--save_every', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data_path', type=str, default='../data/test.jsonl', help="preprocessed MIMIC-CXR test reports")
+    parser.add_argument('--concurrency', type=int, default=1, help="requests in flight, 1 queries sequentially")
+    parser.add_argument('--requests_per_minute', type=int, default=0, help="0 means unlimited")
+    parser.add_argument('--tokens_per_minute', type=int, default=0, help="0 means unlimited")
+    parser.add_argument('--cache_path', type=str, default='../output/response_cache.sqlite', help="response cache, empty string disables it")
+    parser.add_argument('--bypass_cache', action='store_true', help="always query, but still store responses in the cache")
+    parser.add_argument('--topic_aware', action='store_true', help="ground RM/CHG instructions in topics the report mentions")
+    parser.add_argument('--shard', type=int, default=0, help="index of this shard")
+    parser.add_argument('--num_shards', type=int, default=1, help="split the reports across this many independent runs")
+    parser.add_argument('--stream', action='store_true', help="stream completions, parse them into structured records and stop early")
+    parser.add_argument('--edit_mode', action='store_true', help="ask for line edits instead of the full modified report")
+    parser.add_argument('--max_total_tokens', type=int, default=0, help="refuse to start above this many projected tokens, 0 means unlimited")
+    parser.add_argument('--max_cost', type=float, default=0, help="refuse to start above this projected cost in dollars, 0 means unlimited")
+    parser.add_argument('--batch', action='store_true', help="write batch-job request files instead of querying")
+    parser.add_argument('--resume', type=str, default=None, help="output directory of an interrupted run to continue")
+    args = parser.parse_args()
+    generate_data(**vars(args))
\ No newline at end of file
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+
+class Journal:
+    # append-only write-ahead log of completed generation records. every record is
+    # fsynced together with its report index before it counts as done, so a crash
+    # loses at most the request that was in flight
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            repair_tail(path)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def append(self, index, record):
+        self.file.write(json.dumps({'index': index, 'record': record}) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+def repair_tail(path, block_size=65536):
+    # a crash mid-write leaves a torn last line. it is cut off at the last newline, so the
+    # next record starts on a line of its own instead of being glued to it and lost
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(position - block_size, 0)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            f.truncate(position)
+            return end - position
+    return 0
+
+def read_journal(path):
+    # returns {index: record}. a torn last line from a crash mid-write is ignored
+    records = {}
+    if not os.path.exists(path):
+        return records
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[entry['index']] = entry['record']
+    return records
+
+def batch_file(out_dir, batch, save_every, n_reports):
+    # records_{i}.json, where i is the position of the batch's last report in the run
+    return os.path.join(out_dir, f'records_{min((batch + 1) * save_every, n_reports) - 1}.json')
+
+def write_batch(records, out_dir, batch, save_every, n_reports, start_idx=0):
+    # records maps absolute report index to record
+    first = start_idx + batch * save_every
+    data = [records[k] for k in range(first, first + save_every) if k in records]
+    with open(batch_file(out_dir, batch, save_every, n_reports), 'w') as f:
+        json.dump(data, f, indent=4)
+    return len(data)
+
+def rebuild_records(out_dir, start_idx, n_reports, save_every):
+    # regenerate every records_{i}.json of a run, including the trailing partial batch,
+    # from its journal
+    records = read_journal(os.path.join(out_dir, 'journal.jsonl'))
+    n_written = 0
+    for batch in range((n_reports + save_every - 1) // save_every):
+        n_written += write_batch(records, out_dir, batch, save_every, n_reports, start_idx)
+    return n_written
+
+def merge_shards(out_dir, shard_dirs):
+    # combine the journals of a run split with --shard/--num_shards into out_dir,
+    # giving the same records as a single unsharded run
+    runs = []
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, 'run.json'), 'r') as f:
+            runs.append(json.load(f))
+    run = {k: v for k, v in runs[0].items() if k not in ('shard', 'num_shards')}
+    assert all({k: v for k, v in r.items() if k not in ('shard', 'num_shards')} == run for r in runs), \
+        "shards come from runs with different parameters"
+    assert sorted(r['shard'] for r in runs) == list(range(runs[0]['num_shards'])), "missing or duplicate shards"
+
+    os.makedirs(out_dir, exist_ok=True)
+    records = {}
+    for shard_dir in shard_dirs:
+        records.update(read_journal(os.path.join(shard_dir, 'journal.jsonl')))
+    journal = Journal(os.path.join(out_dir, 'journal.jsonl'))
+    for index in sorted(records):
+        journal.append(index, records[index])
+    journal.close()
+    with open(os.path.join(out_dir, 'run.json'), 'w') as f:
+        json.dump({**run, 'shard': 0, 'num_shards': 1}, f, indent=4)
+
+    return rebuild_records(out_dir, run['start_idx'], run['n_reports'], run['save_every'])
+
+if __name__ == '__main__':
+    # python journal.py <output_dir>                         rebuild records from the journal
+    # python journal.py merge <output_dir> <shard_dir> ...   merge sharded runs
+    if sys.argv[1] == 'merge':
+        n_written = merge_shards(sys.argv[2], sys.argv[3:])
+        print(f"merged {len(sys.argv) - 3} shards, {n_written} records in {sys.argv[2]}")
+    else:
+        out_dir = sys.argv[1]
+        with open(os.path.join(out_dir, 'run.json'), 'r') as f:
+            run = json.load(f)
+        n_written = rebuild_records(out_dir, run['start_idx'], run['n_reports'], run['save_every'])
+        print(f"rebuilt {n_written} records in {out_dir}")
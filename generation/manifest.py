@@ -0,0 +1,71 @@
+import os
+import sqlite3
+import hashlib
+
+class Manifest:
+    # sqlite record of every processed report: where it came from, its size/mtime,
+    # content hash, the clean_text version that processed it and the cleaned output
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        if readonly:
+            self.conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        else:
+            self.conn = sqlite3.connect(path)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS reports (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    sha256 TEXT,
+                    version TEXT,
+                    cleaned TEXT,
+                    n_sent INTEGER
+                )''')
+            self.conn.commit()
+
+    def get(self, report_path):
+        return self.conn.execute(
+            'SELECT size, mtime_ns, sha256, version, cleaned, n_sent FROM reports WHERE path = ?',
+            (report_path,)).fetchone()
+
+    def put_many(self, rows):
+        # rows are (path, size, mtime_ns, sha256, version, cleaned, n_sent)
+        self.conn.executemany('INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+# one read-only connection per worker process
+_readers = {}
+
+def get_reader(path):
+    if path not in _readers:
+        _readers[path] = Manifest(path, readonly=True)
+    return _readers[path]
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def cached_clean(manifest, report_path, clean_fn, version):
+    # returns (cleaned, n_sent, row) where row is the manifest update to write,
+    # or None when the cached entry is still valid. the file is only read when
+    # its size/mtime changed, and only re-cleaned when its content hash changed
+    st = os.stat(report_path)
+    entry = manifest.get(report_path) if manifest is not None else None
+
+    if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns and entry[3] == version:
+        return entry[4], entry[5], None
+
+    with open(report_path, 'r') as file:
+        report_text = file.read()
+    digest = content_hash(report_text)
+
+    if entry and entry[2] == digest and entry[3] == version:
+        cleaned, n_sent = entry[4], entry[5]
+    else:
+        cleaned, n_sent = clean_fn(report_text)
+
+    return cleaned, n_sent, (report_path, st.st_size, st.st_mtime_ns, digest, version, cleaned, n_sent)
@@ -0,0 +1,201 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# local stand-in for the Azure OpenAI chat-completions endpoint, with injectable
+# latency and 429 responses. replies echo the original report in the
+# "Instructions: ... Modified Report: ..." layout the setup prompt asks for, and with
+# "stream": true are sent as server-sent events, optionally followed by chatter
+
+CHAT_PATH = re.compile(r'^/openai/deployments/(?P<model>[^/]+)/chat/completions')
+
+def mock_completion(messages):
+    user = messages[-1]['content']
+    n_inst = max(user.count('an instruction to'), 1)
+    report = user.split('Original report:\n', 1)[-1].strip()
+    instructions = ' '.join(f"Instruction {i+1}: Keep line {i+1} unchanged." for i in range(n_inst))
+    if 'Edits:' in messages[0]['content']:
+        # edit-script mode, see edit_ops.py
+        return f"Instructions: {instructions} \n Edits: \nNO CHANGES"
+    return f"Instructions: {instructions} \n Modified Report: \n{report}"
+
+# what a model sometimes keeps generating after the modified report
+CHATTER = "\n\nExample 3: Create the following instruction(s): an instruction to add an observation." * 8
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers={}):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, model, content, token_latency):
+        # one ~4 character chunk per token. the connection is closed after the stream,
+        # a client that stops reading early just drops it
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        base = {'id': f'chatcmpl-mock-{self.server.n_requests}', 'object': 'chat.completion.chunk',
+                'created': int(time.time()), 'model': model}
+        try:
+            for i in range(0, len(content), 4):
+                chunk = {**base, 'choices': [{'index': 0, 'delta': {'content': content[i:i+4]}, 'finish_reason': None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(token_latency)
+            chunk = {**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode('utf-8'))
+        except (BrokenPipeError, ConnectionResetError):
+            with self.server.lock:
+                self.server.n_aborted += 1
+
+    def do_POST(self):
+        config = self.server.config
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+        match = CHAT_PATH.match(self.path)
+        if not match:
+            self._send_json(404, {'error': {'code': '404', 'message': f'unknown path {self.path}'}})
+            return
+
+        with self.server.lock:
+            self.server.n_requests += 1
+            now = time.monotonic()
+            window = [t for t in self.server.recent if now - t < 60]
+            throttled = (config['rate_limit_prob'] and self.server.rng.random() < config['rate_limit_prob']) or \
+                        (config['rpm'] and len(window) >= config['rpm'])
+            if not throttled:
+                window.append(now)
+            self.server.recent = window
+            if throttled:
+                self.server.n_rate_limited += 1
+            latency = config['latency'] * (1 + config['jitter'] * (2 * self.server.rng.random() - 1))
+
+        if throttled:
+            self._send_json(429, {'error': {'code': '429', 'message': 'Rate limit is exceeded.'}},
+                            headers={'Retry-After': str(config['retry_after'])})
+            return
+
+        time.sleep(max(latency, 0))
+
+        messages = body.get('messages', [])
+        content = mock_completion(messages)
+        if body.get('stream'):
+            with self.server.lock:
+                chatter = config['chatter_prob'] and self.server.rng.random() < config['chatter_prob']
+            self._send_stream(match.group('model'), content + CHATTER if chatter else content, config['token_latency'])
+            return
+        prompt_tokens = sum(len(m['content']) for m in messages) // 4
+        completion_tokens = len(content) // 4
+        self._send_json(200, {
+            'id': f'chatcmpl-mock-{self.server.n_requests}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': match.group('model'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop'
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens
+            }
+        })
+
+def process_batch_file(in_path, out_path, error_prob=0.0, seed=0):
+    # stand-in for the batch service: answers every request line of a batch request file
+    # in the batch output format, failing a fraction of them with a 500
+    rng = random.Random(seed)
+    with open(in_path, 'r') as fin, open(out_path, 'w') as fout:
+        for n, line in enumerate(fin):
+            request = json.loads(line)
+            if rng.random() < error_prob:
+                response = {'status_code': 500, 'request_id': f'req-{n}',
+                            'body': {'error': {'code': '500', 'message': 'Internal server error.'}}}
+            else:
+                messages = request['body']['messages']
+                content = mock_completion(messages)
+                prompt_tokens = sum(len(m['content']) for m in messages) // 4
+                completion_tokens = len(content) // 4
+                response = {'status_code': 200, 'request_id': f'req-{n}', 'body': {
+                    'id': f'chatcmpl-batch-{n}',
+                    'object': 'chat.completion',
+                    'model': request['body']['model'],
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                    'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                              'total_tokens': prompt_tokens + completion_tokens}
+                }}
+            fout.write(json.dumps({'id': f'batch-req-{n}', 'custom_id': request['custom_id'],
+                                   'response': response, 'error': None}) + '\n')
+
+def start_server(port=0, latency=0.5, jitter=0.2, rate_limit_prob=0.0, rpm=0, retry_after=1, seed=0,
+                 token_latency=0.0, chatter_prob=0.0):
+    # runs the server on a background thread, returns (server, endpoint)
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockHandler)
+    server.daemon_threads = True
+    server.config = {
+        'latency': latency,
+        'jitter': jitter,
+        'rate_limit_prob': rate_limit_prob,
+        'rpm': rpm,
+        'retry_after': retry_after,
+        'token_latency': token_latency,
+        'chatter_prob': chatter_prob,
+    }
+    server.lock = threading.Lock()
+    server.rng = random.Random(seed)
+    server.recent = []
+    server.n_requests = 0
+    server.n_rate_limited = 0
+    server.n_aborted = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.5, help="seconds per completion")
+    parser.add_argument('--jitter', type=float, default=0.2, help="relative latency jitter")
+    parser.add_argument('--rate_limit_prob', type=float, default=0.0, help="probability of answering 429")
+    parser.add_argument('--rpm', type=int, default=0, help="answer 429 above this many requests per minute")
+    parser.add_argument('--retry_after', type=int, default=1, help="Retry-After seconds sent with 429s")
+    parser.add_argument('--token_latency', type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument('--chatter_prob', type=float, default=0.0, help="probability of a streamed reply running on past the report")
+    parser.add_argument('--batch_dir', type=str, default='', help="answer the batch_requests_*.jsonl files in this directory and exit")
+    parser.add_argument('--batch_error_prob', type=float, default=0.0, help="fraction of batch requests that fail")
+    args = parser.parse_args()
+
+    if args.batch_dir:
+        for path in sorted(glob.glob(os.path.join(args.batch_dir, 'batch_requests_*.jsonl'))):
+            process_batch_file(path, path.replace('batch_requests_', 'batch_results_'), args.batch_error_prob)
+            print(f"processed {path}")
+        sys.exit(0)
+
+    server, endpoint = start_server(args.port, args.latency, args.jitter, args.rate_limit_prob, args.rpm, args.retry_after,
+                                    token_latency=args.token_latency, chatter_prob=args.chatter_prob)
+    print(f"mock chat-completions endpoint listening on {endpoint}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,40 +1,94 @@
 import os
 import re
 import json
+import argparse
 import pandas as pd
 from tqdm import tqdm
+from functools import partial
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor
 import nltk
 nltk.download('punkt')
 from nltk.tokenize import sent_tokenize
 import pysbd
 
+from data_io import JsonlWriter
+from manifest import Manifest, get_reader, cached_clean
+from segment_cache import SegmentCache
+
+# bump whenever clean_text output changes, so manifest entries from older versions are re-cleaned
+CLEAN_TEXT_VERSION = '1'
+
+# patterns are compiled once per process instead of once per report/sentence
+WHITESPACE_PATTERN = re.compile(r'\s{2,}')
+SECTION_PATTERN = re.compile(r'(?i)(?P<findings>FINDING[S]?:)|(?P<impression>IMPRESSION[S]?:)')
+WORD_PATTERN = re.compile(r'\w')
+LEADING_NUMBER_PATTERN = re.compile(r'^\d+[\.\)]\s*')
+
+# pysbd segmenters are reusable, build one per process
+segmenter = pysbd.Segmenter(language="en", clean=False)
+
+# optional persistent segmentation cache, set up per process by init_segment_cache
+segment_cache = None
+
+# cached segmentations are only valid for the pysbd and clean_text versions that made them
+SEGMENT_CACHE_VERSION = f"pysbd-{pysbd.__version__}/clean_text-{CLEAN_TEXT_VERSION}"
+
+def init_segment_cache(path, max_bytes):
+    global segment_cache
+    segment_cache = SegmentCache(path, max_bytes=max_bytes, version=SEGMENT_CACHE_VERSION)
+    # pool workers never return to main, flush their pending entries on exit
+    Finalize(segment_cache, segment_cache.flush, exitpriority=10)
+
+def segment(text):
+    if segment_cache is None:
+        return segmenter.segment(text)
+    return segment_cache.segment(text, segmenter.segment)
+
+def parse_sections(content):
+
+    # single scan over the section headers. findings run from the first FINDINGS header
+    # to the next header of either kind, impression runs from the first IMPRESSION header
+    # to the next IMPRESSION header, matching the original re.split based extraction
+    findings_start = findings_end = None
+    impression_start = impression_end = None
+
+    for match in SECTION_PATTERN.finditer(content):
+        if findings_start is not None and findings_end is None:
+            findings_end = match.start()
+
+        if match.lastgroup == 'findings':
+            if findings_start is None:
+                findings_start = match.end()
+        elif impression_start is None:
+            impression_start = match.end()
+        elif impression_end is None:
+            impression_end = match.start()
+
+        if findings_end is not None and impression_end is not None:
+            break
+
+    findings_text = content[findings_start:findings_end].strip() if findings_start is not None else ""
+    impression_text = content[impression_start:impression_end].strip() if impression_start is not None else ''
+
+    return findings_text, impression_text
+
+def remove_leading_numbers(sentence):
+    return LEADING_NUMBER_PATTERN.sub('', sentence)
+
 def clean_text(content):
 
     content = content.replace('\n', ' ')
-    content = re.sub(r'\s{2,}', ' ', content)
-
-    # split the content to extract the part after "FINDINGS:"
-    findings_split = re.split(r'(?i)FINDING[S]?:', content)
-    if len(findings_split) > 1:
-        findings_part = findings_split[1]
-        findings_text = re.split(r'(?i)IMPRESSION[S]?:', findings_part)[0].strip()
-    else:
-        findings_text = ""
+    content = WHITESPACE_PATTERN.sub(' ', content)
 
-    # split the content to extract the part after "IMPRESSION:"
-    impression_split = re.split(r'(?i)IMPRESSION[S]?:', content)
-    impression_text = impression_split[1].strip() if len(impression_split) > 1 else ''
+    findings_text, impression_text = parse_sections(content)
 
     # split text into sentences
-    seg = pysbd.Segmenter(language="en", clean=False)
-    findings_sentences = seg.segment(findings_text)
-    impression_sentences = seg.segment(impression_text)
-
-    findings_sentences = [sentence for sentence in findings_sentences if bool(re.search(r'\w', sentence))]
-    impression_sentences = [sentence for sentence in impression_sentences if bool(re.search(r'\w', sentence))]
+    findings_sentences = segment(findings_text)
+    impression_sentences = segment(impression_text)
 
-    def remove_leading_numbers(sentence):
-        return re.sub(r'^\d+[\.\)]\s*', '', sentence)
+    findings_sentences = [sentence for sentence in findings_sentences if WORD_PATTERN.search(sentence)]
+    impression_sentences = [sentence for sentence in impression_sentences if WORD_PATTERN.search(sentence)]
 
     findings_sentences = [remove_leading_numbers(sentence) for sentence in findings_sentences]
     impression_sentences = [remove_leading_numbers(sentence) for sentence in impression_sentences]
@@ -64,7 +118,28 @@ def clean_text(content):
 
     return numbered_text, len(findings_sentences) + len(impression_sentences)
 
-def main():
+def process_patient(patient_dir, manifest_path=''):
+
+    # clean every report of a single patient, in directory listing order. with a
+    # manifest, unchanged reports reuse their cached output instead of being re-cleaned
+    patient_id = os.path.basename(os.path.normpath(patient_dir))
+    manifest = get_reader(manifest_path) if manifest_path else None
+    cache_before = segment_cache.stats() if segment_cache is not None else (0, 0)
+    results = []
+    updates = []
+    for report_file in os.listdir(patient_dir):
+        cleaned, n_sent, update = cached_clean(
+            manifest, os.path.join(patient_dir, report_file), clean_text, CLEAN_TEXT_VERSION)
+        results.append((patient_id, report_file, cleaned, n_sent))
+        if update is not None:
+            updates.append(update)
+
+    cache_after = segment_cache.stats() if segment_cache is not None else (0, 0)
+    cache_stats = (cache_after[0] - cache_before[0], cache_after[1] - cache_before[1])
+
+    return results, updates, cache_stats
+
+def main(args):
 
     data_path = '../data/'
     split = pd.read_csv(os.path.join(data_path, 'mimic-cxr-2.0.0-split.csv'))
@@ -88,51 +163,121 @@ def main():
     assert len(overlap) == 0
 
     base_path = os.path.join(os.environ['HOME'], 'radedit/data/files/')
-    train_reports = []
-    test_reports = []
+
+    # jsonl streams each report to disk as soon as it is cleaned, json keeps the
+    # legacy behaviour of dumping whole lists at the end
+    if args.output_format == 'json':
+        train_reports = []
+        test_reports = []
+        write_train, write_test = train_reports.append, test_reports.append
+    else:
+        suffix = '.jsonl.gz' if args.compress else '.jsonl'
+        train_writer = JsonlWriter(os.path.join(data_path, 'train' + suffix))
+        test_writer = JsonlWriter(os.path.join(data_path, 'test' + suffix))
+        write_train, write_test = train_writer.write, test_writer.write
+    test_patients = set()
+
+    # shard by patient directory; executor.map yields shards in submission order,
+    # so the merged output is identical to the serial run
+    cache_args = (args.segment_cache, args.segment_cache_mb * 1024 * 1024)
+    if args.segment_cache:
+        # create the cache tables before any worker opens them
+        SegmentCache(*cache_args).close()
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=init_segment_cache if args.segment_cache else None,
+            initargs=cache_args if args.segment_cache else ())
+    else:
+        executor = None
+        if args.segment_cache:
+            init_segment_cache(*cache_args)
+
+    manifest = Manifest(args.manifest) if args.manifest else None
+    worker_fn = partial(process_patient, manifest_path=args.manifest)
+    n_updated = 0
+    n_reports = 0
+    cache_hits = 0
+    cache_misses = 0
 
     n_sents = []
     for p in range(10, 20):
         path =os.path.join(base_path, f'p{p}/') 
         print(f"Working on files in {path}")
 
-        for entry in tqdm(os.listdir(path)):
-            if os.path.isdir(os.path.join(path, entry)):
-                patient_id = entry
-                report_files = os.listdir(os.path.join(path, entry))
-                for report_file in report_files:
-                    with open(os.path.join(path, entry, report_file), 'r') as file:
-                        report_text = file.read()
-
-                    cleaned, n_sent = clean_text(report_text)
-                    if "FINDINGS:" in cleaned.upper() or "IMPRESSION:" in cleaned.upper():
-                        if patient_id in subject_ids_train:
-                            train_reports.append({
-                                'patient_id': patient_id, 
-                                'report_id': report_file,
-                                'report_text': cleaned
-                            })
-                        elif patient_id in subject_ids_test:
-                            test_reports.append({
-                                'patient_id': patient_id, 
-                                'report_id': report_file,
-                                'report_text': cleaned
-                            })
-                            n_sents.append(n_sent)
+        patient_dirs = [os.path.join(path, entry) for entry in os.listdir(path) if os.path.isdir(os.path.join(path, entry))]
+        if executor is not None:
+            shards = executor.map(worker_fn, patient_dirs, chunksize=args.chunksize)
+        else:
+            shards = map(worker_fn, patient_dirs)
+
+        manifest_updates = []
+        for shard, updates, (hits, misses) in tqdm(shards, total=len(patient_dirs)):
+            manifest_updates.extend(updates)
+            cache_hits += hits
+            cache_misses += misses
+            n_reports += len(shard)
+            for patient_id, report_file, cleaned, n_sent in shard:
+                if "FINDINGS:" in cleaned.upper() or "IMPRESSION:" in cleaned.upper():
+                    if patient_id in subject_ids_train:
+                        write_train({
+                            'patient_id': patient_id, 
+                            'report_id': report_file,
+                            'report_text': cleaned
+                        })
+                    elif patient_id in subject_ids_test:
+                        write_test({
+                            'patient_id': patient_id, 
+                            'report_id': report_file,
+                            'report_text': cleaned
+                        })
+                        test_patients.add(patient_id)
+                        n_sents.append(n_sent)
+
+        if manifest is not None:
+            manifest.put_many(manifest_updates)
+        n_updated += len(manifest_updates)
+
+    if executor is not None:
+        executor.shutdown()
+
+    if manifest is not None:
+        manifest.close()
+        print(f"manifest: reused {n_reports - n_updated} of {n_reports} reports, {n_updated} new or changed")
+
+    if segment_cache is not None:
+        segment_cache.close()
+    if args.segment_cache:
+        lookups = cache_hits + cache_misses
+        print(f"segmentation cache: {cache_hits} hits, {cache_misses} misses "
+              f"({cache_hits / lookups if lookups else 0:.1%} hit rate)")
     
-    print(f"total patients in test set after processing {len(set([r['patient_id'] for r in test_reports]))}")
-    print(f"total report in test set after processing {len(test_reports)}")
+    print(f"total patients in test set after processing {len(test_patients)}")
+    print(f"total report in test set after processing {len(n_sents)}")
 
     with open(os.path.join(data_path, 'report_length.txt'), 'w') as file:
         for l in n_sents:
             file.write(f"{l}\n")
 
-    with open(os.path.join(data_path, 'train.json'), 'w') as json_file:
-        json.dump(train_reports, json_file, indent=4)
+    if args.output_format == 'json':
+        with open(os.path.join(data_path, 'train.json'), 'w') as json_file:
+            json.dump(train_reports, json_file, indent=4)
 
-    with open(os.path.join(data_path, 'test.json'), 'w') as json_file:
-        json.dump(test_reports, json_file, indent=4)
+        with open(os.path.join(data_path, 'test.json'), 'w') as json_file:
+            json.dump(test_reports, json_file, indent=4)
+    else:
+        train_writer.close()
+        test_writer.close()
         
         
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help="number of worker processes, 1 runs serially")
+    parser.add_argument('--chunksize', type=int, default=16, help="patient directories sent to a worker at a time")
+    parser.add_argument('--output_format', type=str, default='jsonl', choices=['jsonl', 'json'], help="stream one report per line, or dump JSON lists at the end")
+    parser.add_argument('--manifest', type=str, default='../data/preprocess_manifest.sqlite', help="manifest of processed reports for incremental reruns, empty string disables it")
+    parser.add_argument('--segment_cache', type=str, default='../data/segment_cache.sqlite', help="persistent sentence segmentation cache, empty string disables it")
+    parser.add_argument('--segment_cache_mb', type=int, default=512, help="size limit of the segmentation cache, least recently used entries are evicted")
+    parser.add_argument('--compress', action='store_true', help="gzip the jsonl output")
+    args = parser.parse_args()
+    main(args)
\ No newline at end of file
@@ -0,0 +1,115 @@
+import re
+from collections import Counter, defaultdict
+
+from utils import (SETUP_PROMPT, EXAMPLE1_PROMPT, EXAMPLE2_PROMPT, EDIT_SETUP_PROMPT, EDIT_EXAMPLE1_PROMPT, EDIT_EXAMPLE2_PROMPT,
+                   InstType, build_messages, estimate_cost)
+
+# local prompt-size accounting: token counts per prompt section, cumulative prompt and
+# completion tokens, and cost per instruction type. tiktoken is used when it is installed,
+# otherwise counts fall back to ~4 characters per token
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# chat formatting tokens added per message
+MESSAGE_OVERHEAD = 4
+
+STATIC_SECTIONS = {'setup': SETUP_PROMPT, 'example1': EXAMPLE1_PROMPT, 'example2': EXAMPLE2_PROMPT}
+EDIT_STATIC_SECTIONS = {'setup': EDIT_SETUP_PROMPT, 'example1': EDIT_EXAMPLE1_PROMPT, 'example2': EDIT_EXAMPLE2_PROMPT}
+
+INST_TYPE_PATTERN = re.compile('an instruction to (' + '|'.join(
+    re.escape(t.value) for t in sorted(InstType, key=lambda t: -len(t.value))) + ')')
+INST_TYPES = {t.value: t for t in InstType}
+
+_encoding = None
+
+def count_tokens(text):
+    global _encoding
+    if tiktoken is None:
+        return len(text) // 4
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding('cl100k_base')
+    return len(_encoding.encode(text))
+
+_static_tokens = {}
+
+def static_tokens(edit_mode=False):
+    # the system prompt never changes, so it is counted once
+    if edit_mode not in _static_tokens:
+        sections = EDIT_STATIC_SECTIONS if edit_mode else STATIC_SECTIONS
+        _static_tokens[edit_mode] = {name: count_tokens(text) for name, text in sections.items()}
+    return _static_tokens[edit_mode]
+
+def section_tokens(instructions, report, edit_mode=False):
+    user = build_messages(instructions, report, edit_mode)[1]['content']
+    counts = dict(static_tokens(edit_mode))
+    counts['instructions'] = count_tokens(instructions)
+    counts['report'] = count_tokens(report)
+    counts['template'] = max(count_tokens(user) - counts['instructions'] - counts['report'], 0) + 2 * MESSAGE_OVERHEAD
+    return counts
+
+def prompt_tokens(instructions, report, edit_mode=False):
+    return sum(section_tokens(instructions, report, edit_mode).values())
+
+def inst_types(instructions):
+    return [INST_TYPES[m] for m in INST_TYPE_PATTERN.findall(instructions)]
+
+def preflight(queries, max_tokens=500, token_budget=0, cost_budget=0, discount=1.0, edit_mode=False):
+    # projects the tokens and cost of a run before it starts, assuming every completion
+    # uses all of max_tokens, and refuses to start one that exceeds a budget (0 is no limit)
+    n_prompt = sum(prompt_tokens(instructions, report, edit_mode) for instructions, report in queries)
+    n_completion = max_tokens * len(queries)
+    cost = discount * estimate_cost(n_prompt, n_completion)
+    print(f"projected for {len(queries)} requests: at most {n_prompt} prompt + {n_completion} completion tokens, "
+          f"at most ${cost:.2f}")
+    if token_budget and n_prompt + n_completion > token_budget:
+        raise ValueError(f"projected {n_prompt + n_completion} tokens exceed the budget of {token_budget}")
+    if cost_budget and cost > cost_budget:
+        raise ValueError(f"projected ${cost:.2f} exceeds the budget of ${cost_budget:.2f}")
+    return n_prompt, n_completion, cost
+
+class PromptStats:
+
+    def __init__(self, edit_mode=False):
+        self.edit_mode = edit_mode
+        self.n_requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.sections = Counter()
+        self.cost_by_type = defaultdict(float)
+        self.count_by_type = Counter()
+
+    def add(self, instructions, report, completion):
+        counts = section_tokens(instructions, report, self.edit_mode)
+        n_prompt = sum(counts.values())
+        n_completion = count_tokens(completion)
+        self.n_requests += 1
+        self.prompt_tokens += n_prompt
+        self.completion_tokens += n_completion
+        self.sections.update(counts)
+
+        # a request's cost is split evenly over the instructions it asks for
+        types = inst_types(instructions)
+        cost = estimate_cost(n_prompt, n_completion)
+        for t in types:
+            self.cost_by_type[t] += cost / len(types)
+            self.count_by_type[t] += 1
+        return n_prompt, n_completion
+
+    def report(self):
+        if not self.n_requests:
+            return "prompt stats: no requests"
+        n = self.n_requests
+        static = sum(self.sections[name] for name in STATIC_SECTIONS)
+        lines = [
+            f"prompt stats over {n} requests ({'tiktoken' if tiktoken else '~4 chars/token'}): "
+            f"{self.prompt_tokens} prompt + {self.completion_tokens} completion tokens, "
+            f"estimated ${estimate_cost(self.prompt_tokens, self.completion_tokens):.2f}",
+            "  tokens per request: " + ', '.join(f"{name} {count / n:.0f}" for name, count in self.sections.items()),
+            f"  static prefix is {static / self.prompt_tokens:.1%} of prompt tokens"
+        ]
+        for t, cost in sorted(self.cost_by_type.items(), key=lambda item: -item[1]):
+            lines.append(f"  {t.name:<20} {self.count_by_type[t]:>6} instructions  ${cost:.2f}")
+        return '\n'.join(lines)
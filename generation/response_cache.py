@@ -0,0 +1,90 @@
+import json
+import time
+import sqlite3
+import hashlib
+
+class ResponseCache:
+    # on-disk cache of chat completions, keyed by everything that determines the request:
+    # the full message list (system prompt and user message), model, max_tokens and temperature,
+    # and whether the completion was streamed (a streamed one was parsed while it arrived).
+    # entries are evicted least-recently-used once the cache grows past max_bytes.
+    # with bypass=True lookups always miss, but fresh responses are still stored
+
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024, bypass=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.saved_cost = 0
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                completion TEXT,
+                cost REAL,
+                size INTEGER,
+                last_used INTEGER
+            )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self.conn.commit()
+        self.total = self._total_size()
+
+    def _total_size(self):
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def key(messages, model, max_tokens, temperature, stream=False):
+        # keys of non-streamed requests are unchanged, so existing caches stay valid
+        payload = json.dumps([messages, model, max_tokens, temperature] + (['stream'] if stream else []), sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        # returns the cached completion, or None on a miss
+        row = None if self.bypass else self.conn.execute(
+            'SELECT completion, cost FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.saved_cost += row[1]
+        with self.conn:
+            self.conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time_ns(), key))
+        return row[0]
+
+    def put(self, key, completion, cost):
+        size = len(completion.encode('utf-8'))
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                              (key, completion, cost, size, time.time_ns()))
+        # running total is an upper bound (replaced entries are counted twice), evict recomputes it
+        self.total += size
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        total = self._total_size()
+        if total <= self.max_bytes:
+            self.total = total
+            return
+        # drop the least recently used entries until the cache is back to 90% of its budget
+        excess = total - int(self.max_bytes * 0.9)
+        with self.conn:
+            self.conn.execute('''
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, size, SUM(size) OVER (ORDER BY last_used, key) AS freed FROM responses
+                    ) WHERE freed - size < ?
+                )''', (excess,))
+        self.total = self._total_size()
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return (f"response cache: {self.hits} hits, {self.misses} misses "
+                f"({self.hits / lookups if lookups else 0:.1%} hit rate), saved ${self.saved_cost:.2f}")
+
+    def close(self):
+        self.conn.close()
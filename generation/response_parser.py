@@ -0,0 +1,164 @@
+import re
+
+# incremental parser for completions in the layout the setup prompt asks for:
+#   Instructions: Instruction 1: ... Instruction 2: ...
+#   Modified Report: FINDINGS: 1. ... IMPRESSION: 2. ...
+# the "Instructions:" header may be left out, as in the prompt's second example.
+# it is fed the completion as it streams in and decides, line by line, whether the
+# modified report is complete (anything after it is commentary or a new example) or
+# the response is malformed, so generation can be stopped early in both cases
+
+INSTRUCTIONS_HEADER = re.compile(r'(?i)instructions?\s*:')
+REPORT_HEADER = re.compile(r'(?i)modified\s+report\s*:')
+INSTRUCTION_SPLIT = re.compile(r'(?i)\bins\w*ruction\s*\d+\s*:')
+SECTION_HEADER = re.compile(r'(?i)^(FINDINGS?|IMPRESSIONS?)\s*:\s*(.*)$')
+NUMBERED_LINE = re.compile(r'^(\d+)\s*[\.\)]\s*(.*)$')
+NEW_TURN = re.compile(r'(?i)^(example\b|original report\s*:|instructions?\s*:|input\s*:|output\s*:|note\b|explanation\b)')
+# a further numbered sentence on the same line, e.g. the "2." of "1. A. 2. B."
+INLINE_NUMBER = re.compile(r'(?<=[\.\?!])\s+(\d+)\s*[\.\)]\s+(?=\S)')
+
+def format_report(sections):
+    # [(section, [sentences])] -> renumbered report, in the same layout clean_text produces
+    lines = []
+    number = 1
+    for k, (section, sentences) in enumerate(sections):
+        if k:
+            lines.append('\n')
+        lines.append(f'{section}:\n')
+        for sentence in sentences:
+            lines.append(f'{number}. {sentence}\n')
+            number += 1
+    return ''.join(lines)
+
+def split_numbered(number, text):
+    # sentences numbered number, number + 1, ... on one line. only consecutive numbers after
+    # the end of a sentence split it, so "measuring 2. 5 cm" stays whole
+    sentences = []
+    start = 0
+    for match in INLINE_NUMBER.finditer(text):
+        if int(match.group(1)) == number + 1:
+            sentences.append(text[start:match.start()])
+            start = match.end()
+            number += 1
+    sentences.append(text[start:])
+    return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+class ResponseParser:
+
+    def __init__(self):
+        self.text = ''
+        self.pending = ''
+        self.state = 'preamble'
+        self.instruction_text = ''
+        self.sections = []
+        self.error = None
+
+    @property
+    def done(self):
+        return self.state in ('complete', 'malformed')
+
+    def feed(self, delta):
+        # returns True once the response is complete or malformed
+        self.text += delta
+        if self.done:
+            return True
+        self.pending += delta
+        *lines, self.pending = self.pending.split('\n')
+        for line in lines:
+            self._line(line)
+            if self.done:
+                return True
+        # a preamble is not given up on while streaming, the report may still follow it
+        return self.done
+
+    def finish(self):
+        if not self.done and self.pending:
+            self._line(self.pending)
+            self.pending = ''
+        if self.state == 'report' and self.n_sentences():
+            self.state = 'complete'
+        elif not self.done:
+            self._malformed(f'response ended while parsing the {self.state}')
+        return self.result()
+
+    def _malformed(self, error):
+        self.state = 'malformed'
+        self.error = error
+
+    def _line(self, line):
+        if self.state == 'preamble':
+            header = INSTRUCTIONS_HEADER.search(line)
+            instruction = INSTRUCTION_SPLIT.search(line)
+            report = REPORT_HEADER.search(line)
+            starts = [m.start() for m in (header, instruction, report) if m]
+            if not starts:
+                return
+            self.state = 'instructions'
+            if header and header.start() == min(starts):
+                line = line[header.end():]
+            else:
+                # "Instruction 1: ..." without a header, or straight to "Modified Report:"
+                line = line[min(starts):]
+
+        if self.state == 'instructions':
+            match = REPORT_HEADER.search(line)
+            if not match:
+                self.instruction_text += line + '\n'
+                return
+            self.instruction_text += line[:match.start()]
+            self.state = 'report'
+            line = line[match.end():]
+
+        self._report_line(line.strip())
+
+    def _report_line(self, line):
+        if not line:
+            return
+        if NEW_TURN.match(line):
+            self._end_report('report followed by a new turn')
+            return
+
+        header = SECTION_HEADER.match(line)
+        if header:
+            self.sections.append(('FINDINGS' if header.group(1).upper().startswith('F') else 'IMPRESSION', []))
+            if header.group(2).strip():
+                self._report_line(header.group(2).strip())
+            return
+
+        numbered = NUMBERED_LINE.match(line)
+        if numbered and self.sections:
+            self.sections[-1][1].extend(split_numbered(int(numbered.group(1)), numbered.group(2)))
+            return
+
+        self._end_report(f'unexpected line in the modified report: {line[:80]!r}')
+
+    def _end_report(self, reason):
+        # trailing content after a finished report ends it, before any sentence it is malformed
+        if self.n_sentences():
+            self.state = 'complete'
+        else:
+            self._malformed(reason)
+
+    def n_sentences(self):
+        return sum(len(sentences) for _, sentences in self.sections)
+
+    def instructions(self):
+        parts = INSTRUCTION_SPLIT.split(self.instruction_text)
+        return [part.strip() for part in parts if part.strip()]
+
+    def modified_report(self):
+        return format_report(self.sections)
+
+    def result(self):
+        return {
+            'valid': self.state == 'complete',
+            'error': self.error,
+            'instructions': self.instructions(),
+            'modified_report': self.modified_report() if self.state == 'complete' else None
+        }
+
+def parse_response(text):
+    # parse a full (non-streamed) completion
+    parser = ResponseParser()
+    parser.feed(text)
+    return parser.finish()
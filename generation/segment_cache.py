@@ -0,0 +1,119 @@
+import json
+import time
+import sqlite3
+import hashlib
+from collections import OrderedDict
+
+class SegmentCache:
+    # persistent sentence segmentation cache shared by all preprocessing processes.
+    # entries are keyed by a hash of the section text (already whitespace-normalized by
+    # clean_text) and of version, which names the segmenter and clean_text versions so an
+    # upgrade of either misses instead of serving stale segmentations. entries are evicted
+    # least-recently-used once the cache grows past max_bytes.
+    # a small in-process LRU sits in front of sqlite for the most repeated boilerplate
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, memory_entries=10000, flush_every=1000, version=''):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = version
+        self.memory_entries = memory_entries
+        self.flush_every = flush_every
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS segments (
+                key TEXT PRIMARY KEY,
+                sentences TEXT,
+                size INTEGER,
+                last_used INTEGER
+            )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS segments_last_used ON segments (last_used)')
+        self.conn.commit()
+        self.total = self._total_size()
+
+        self.memory = OrderedDict()
+        self.pending = {}
+        self.touched = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _total_size(self):
+        return self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM segments').fetchone()[0]
+
+    def key(self, text):
+        return hashlib.sha1(f"{self.version}\0{text}".encode('utf-8')).hexdigest()
+
+    def segment(self, text, segment_fn):
+        key = self.key(text)
+
+        sentences = self.memory.get(key)
+        if sentences is None:
+            sentences = self.pending.get(key)
+        if sentences is None:
+            row = self.conn.execute('SELECT sentences FROM segments WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                sentences = json.loads(row[0])
+
+        if sentences is None:
+            self.misses += 1
+            sentences = segment_fn(text)
+            self.pending[key] = sentences
+        else:
+            self.hits += 1
+            self.touched.add(key)
+
+        self.memory[key] = sentences
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+        if len(self.pending) + len(self.touched) >= self.flush_every:
+            self.flush()
+
+        # callers get their own list, the cached one must not be mutated
+        return list(sentences)
+
+    def flush(self):
+        if not self.pending and not self.touched:
+            return
+        now = time.time_ns()
+        rows = []
+        for key, sentences in self.pending.items():
+            value = json.dumps(sentences)
+            rows.append((key, value, len(value), now))
+
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?)', rows)
+            self.conn.executemany('UPDATE segments SET last_used = ? WHERE key = ?',
+                                  [(now, key) for key in self.touched])
+        self.pending = {}
+        self.touched = set()
+        # running total is an upper bound (replaced entries are counted twice), evict recomputes it.
+        # entries added by other processes are only seen then
+        self.total += sum(row[2] for row in rows)
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        total = self._total_size()
+        if total <= self.max_bytes:
+            self.total = total
+            return
+        # drop the least recently used entries until the cache is back to 90% of its budget
+        excess = total - int(self.max_bytes * 0.9)
+        with self.conn:
+            self.conn.execute('''
+                DELETE FROM segments WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, size, SUM(size) OVER (ORDER BY last_used, key) AS freed FROM segments
+                    ) WHERE freed - size < ?
+                )''', (excess,))
+        self.total = self._total_size()
+
+    def stats(self):
+        return self.hits, self.misses
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -1,7 +1,14 @@
+import os
+import time
+import random
+import httpx
+import openai
 from enum import Enum
 from openai import AzureOpenAI
 from torch.utils.data import Dataset
 
+from response_parser import ResponseParser, parse_response
+
 class InstType(Enum):
     ADD_OBS           = "add an observation"
     RM_OBS            = "remove an observation"
@@ -161,17 +168,12 @@ def estimate_cost(prompt_tokens, completion_tokens):
     
     return (input_cost*prompt_tokens/1000 + output_cost*completion_tokens/1000)
 
-def query_openai(instructions, report, max_tokens=500, temperature=.4):
-    API_VERSION = "2023-05-15"
-    GPT_MODEL = 'gpt41106'
-
-    client = AzureOpenAI(
-        api_key = API_KEY, 
-        api_version = API_VERSION,
-        azure_endpoint="https://xzhang.openai.azure.com"
-    )
+API_KEY = os.environ.get('AZURE_OPENAI_API_KEY', '')
+API_VERSION = "2023-05-15"
+GPT_MODEL = 'gpt41106'
+AZURE_ENDPOINT = "https://xzhang.openai.azure.com"
 
-    setup = """
+SETUP_PROMPT = """
         Suppose you are an expert radiologist and are given a radiology report writen by your assistant. 
         Give specific instructions to your assistant on modifying the report. 
         I will provide you with the type of instructions to make and the clinical topics to focus on.  
@@ -184,7 +186,7 @@ def query_openai(instructions, report, max_tokens=500, temperature=.4):
         Follow this example:
     """
 
-    example1 = """
+EXAMPLE1_PROMPT = """
         Example 1: Create the following instruction(s): an instruction to adds an observation to the entire report about consolidation; 
         an instruction to remove an observation about cardiac silhouette in the impression section;
         Original report:  
@@ -202,8 +204,8 @@ def query_openai(instructions, report, max_tokens=500, temperature=.4):
         IMPRESSION: 
         4. No focal consolidation, pleural effusion, or evidence of pneumothorax 
     """
-    
-    example2 = """
+
+EXAMPLE2_PROMPT = """
         Example 2: Create the following instruction(s): an instruction to change the anatomical location of an observation.
         Then provide the modified report.
         Original report: 
@@ -223,28 +225,240 @@ def query_openai(instructions, report, max_tokens=500, temperature=.4):
         3. Left mainstem intubation.
     """
 
+def estimate_prompt_tokens(messages):
+    # rough local estimate, ~4 characters per token
+    return sum(len(m['content']) for m in messages) // 4
 
-    # print(setup+example1+example2)
-    try:
-        response = client.chat.completions.create(
-            model=GPT_MODEL, 
-            messages = [
-                {'role': 'system', 'content': setup+example1+example2},
-                # {'role': 'system', 'content': setup+example1},
-                {'role': 'user', 'content': 
-                    f"For the following original report, {instructions}. Original report:\n {report}"}
-            ], 
-            max_tokens=max_tokens,
-            temperature=temperature
+EDIT_SETUP_PROMPT = """
+        Suppose you are an expert radiologist and are given a radiology report writen by your assistant. 
+        Give specific instructions to your assistant on modifying the report. 
+        I will provide you with the type of instructions to make and the clinical topics to focus on.  
+        There is no imaging involved. Create instructions that are specific, well-defined, concise, and applicable to the report. 
+        If the instruction I asked you to make does not apply to the report, you can create one that does. 
+        If there are multiple instructions for a report, they should be based on the original report.
+        If an instruction applies to multiple instances in the report, make sure to make all adjustments accordingly.
+        Instead of the modified report, give the line edits that turn the original report into it, one per line:
+        REPLACE <line>: <new sentence>, INSERT AFTER <line>: <new sentence> (INSERT AFTER 0 adds it before the first line),
+        APPEND FINDINGS: <new sentence>, APPEND IMPRESSION: <new sentence> or DELETE <line>.
+        Line numbers always refer to the original report. For your reply, format them this way: 
+        Instructions: Instruction 1:.... Instruction 2:.... \n Edits: ...
+        Follow this example:
+    """
+
+EDIT_EXAMPLE1_PROMPT = """
+        Example 1: Create the following instruction(s): an instruction to adds an observation to the entire report about consolidation; 
+        an instruction to remove an observation about cardiac silhouette in the impression section;
+        Original report:  
+        FINDINGS:
+        1. AP and lateral views of the chest were obtained.
+        2. The right costophrenic angle is not fully included on the image.
+        IMPRESSION: 
+        3. Top normal cardiac silhouette without pleural effusion or pulmonary edema.
+        Instructions: Instruction 1: Add no focal consolidation, pleural effusion, pneumothorax to both the findings and impression sections. Instruction 2: Remove Line 3 in the original report.  
+        Edits:
+        INSERT AFTER 2: No focal consolidation, pleural effusion, or evidence of pneumothorax is seen.
+        DELETE 3
+        APPEND IMPRESSION: No focal consolidation, pleural effusion, or evidence of pneumothorax.
+    """
+
+EDIT_EXAMPLE2_PROMPT = """
+        Example 2: Create the following instruction(s): an instruction to change the anatomical location of an observation.
+        Then provide the edits.
+        Original report: 
+        FINDINGS: 
+        1. Endotracheal tube is seen with tip in the right mainstem bronchus.
+        2. Hazy right basilar opacity may be due to atelectasis. 
+        3. Right mainstem intubation is seen.
+        IMPRESSION: 
+        4. Right mainstem intubation.
+        Instructions: Instruction 1: Change intubation to left. 
+        Edits:
+        REPLACE 3: Left mainstem intubation is seen.
+        REPLACE 4: Left mainstem intubation.
+    """
+
+# static prefix shared by every request. it is built once and always sent first, so it is
+# byte-identical across requests and provider-side prompt prefix caching can apply to it
+SYSTEM_PROMPT = SETUP_PROMPT+EXAMPLE1_PROMPT+EXAMPLE2_PROMPT
+# edit-script mode, see edit_ops.py
+EDIT_SYSTEM_PROMPT = EDIT_SETUP_PROMPT+EDIT_EXAMPLE1_PROMPT+EDIT_EXAMPLE2_PROMPT
+
+def build_messages(instructions, report, edit_mode=False):
+    # only the user message varies between requests
+    return [
+        {'role': 'system', 'content': EDIT_SYSTEM_PROMPT if edit_mode else SYSTEM_PROMPT},
+        {'role': 'user', 'content': 
+            f"For the following original report, {instructions}. Original report:\n {report}"}
+    ]
+
+class QueryError(Exception):
+    # structured failure of a chat completion request after the retry policy gave up
+    def __init__(self, message, status_code=None, attempts=0, retryable=False, cause=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.attempts = attempts
+        self.retryable = retryable
+        self.cause = cause
+
+    def to_dict(self):
+        return {
+            'error': type(self.cause).__name__ if self.cause is not None else 'QueryError',
+            'message': self.message,
+            'status_code': self.status_code,
+            'attempts': self.attempts,
+            'retryable': self.retryable
+        }
+
+class RetryPolicy:
+    # bounded exponential backoff with full jitter. a Retry-After sent by the server
+    # takes precedence over the computed backoff, but is still capped at max_delay
+    RETRYABLE = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+    def __init__(self, max_retries=6, base_delay=1.0, max_delay=60.0, seed=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # own RNG, so jitter never touches the global stream used for instruction sampling
+        self.rng = random.Random(seed)
+
+    def is_retryable(self, error):
+        return isinstance(error, self.RETRYABLE)
+
+    @staticmethod
+    def retry_after(error):
+        response = getattr(error, 'response', None)
+        if response is None:
+            return None
+        try:
+            if 'retry-after-ms' in response.headers:
+                return float(response.headers['retry-after-ms']) / 1000
+            if 'retry-after' in response.headers:
+                return float(response.headers['retry-after'])
+        except ValueError:
+            pass
+        return None
+
+    def delay(self, attempt, error=None):
+        retry_after = self.retry_after(error) if error is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return self.rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def to_query_error(self, error, attempts):
+        return QueryError(str(error), status_code=getattr(error, 'status_code', None), attempts=attempts,
+                          retryable=self.is_retryable(error), cause=error)
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+# long-lived clients, one per endpoint, so requests reuse pooled keep-alive connections
+_clients = {}
+
+def get_client(max_connections=16):
+    key = (AZURE_ENDPOINT, API_KEY)
+    if key not in _clients:
+        _clients[key] = AzureOpenAI(
+            api_key = API_KEY, 
+            api_version = API_VERSION,
+            azure_endpoint=AZURE_ENDPOINT,
+            # retries are handled by RetryPolicy
+            max_retries=0,
+            http_client=httpx.Client(limits=httpx.Limits(
+                max_connections=max_connections, max_keepalive_connections=max_connections))
         )
+    return _clients[key]
+
+def query_openai(instructions, report, max_tokens=500, temperature=.4, cache=None, retry_policy=DEFAULT_RETRY_POLICY,
+                 edit_mode=False):
+
+    # with a ResponseCache, identical requests are served from disk at no cost
+    messages = build_messages(instructions, report, edit_mode)
+    if cache is not None:
+        key = cache.key(messages, GPT_MODEL, max_tokens, temperature)
+        completion = cache.get(key)
+        if completion is not None:
+            return completion, 0
+
+    client = get_client()
+
+    for attempt in range(retry_policy.max_retries + 1):
+        try:
+            response = client.chat.completions.create(
+                model=GPT_MODEL, 
+                messages = messages, 
+                max_tokens=max_tokens,
+                temperature=temperature
+            )
+        except Exception as e:
+            if not retry_policy.is_retryable(e) or attempt == retry_policy.max_retries:
+                raise retry_policy.to_query_error(e, attempt + 1) from e
+            delay = retry_policy.delay(attempt, e)
+            print(f"{type(e).__name__}: {e}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+
         completion=response.choices[0].message.content
         cost = estimate_cost(response.usage.prompt_tokens, response.usage.completion_tokens)
+        if cache is not None:
+            cache.put(key, completion, cost)
         return completion, cost
-    
-    except Exception as e:
-        print(e)
-        # time.sleep(5)
-        return query_openai(instructions, report, max_tokens, temperature)
+
+def query_openai_stream(instructions, report, max_tokens=500, temperature=.4, cache=None, retry_policy=DEFAULT_RETRY_POLICY):
+
+    # streams the completion through a ResponseParser and closes the stream as soon as the
+    # modified report is complete or the response is malformed. returns (completion, cost, parsed)
+    # where parsed holds the instruction list, the renumbered modified report, time to first
+    # token and total latency
+    messages = build_messages(instructions, report)
+    if cache is not None:
+        key = cache.key(messages, GPT_MODEL, max_tokens, temperature, stream=True)
+        completion = cache.get(key)
+        if completion is not None:
+            return completion, 0, {**parse_response(completion), 'aborted': False, 'ttft': None, 'latency': None}
+
+    client = get_client()
+
+    for attempt in range(retry_policy.max_retries + 1):
+        parser = ResponseParser()
+        start = time.perf_counter()
+        ttft = None
+        aborted = False
+        try:
+            stream = client.chat.completions.create(
+                model=GPT_MODEL, 
+                messages = messages, 
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True
+            )
+            try:
+                for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if not delta:
+                        continue
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    if parser.feed(delta):
+                        aborted = True
+                        break
+            finally:
+                stream.close()
+        except Exception as e:
+            if not retry_policy.is_retryable(e) or attempt == retry_policy.max_retries:
+                raise retry_policy.to_query_error(e, attempt + 1) from e
+            delay = retry_policy.delay(attempt, e)
+            print(f"{type(e).__name__}: {e}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+
+        parsed = {**parser.finish(), 'aborted': aborted, 'ttft': ttft, 'latency': time.perf_counter() - start}
+        completion = parser.text
+        # streamed responses carry no usage, so the cost is estimated from the text
+        cost = estimate_cost(estimate_prompt_tokens(messages), len(completion) // 4)
+        # a stream closed early holds a truncated completion, which must not be replayed
+        if cache is not None and parsed['valid'] and not aborted:
+            cache.put(key, completion, cost)
+        return completion, cost, parsed
 
 
 class GeneratedDataset(Dataset):